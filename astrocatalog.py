@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' compact binary catalog of precomputed newmoons and solar terms
+
+The catalog is a flat file memory-mapped read-only, processes open the same
+file share the same pages. Layout, all integers are little-endian:
+
+    header  magic b'LCAT', format version uint32, engine and engine version
+            as 16 bytes NUL padded strings, then int64 first lunation number,
+            int64 newmoon count, int64 first solar term number, int64 solar
+            term count
+    body    newmoons, then solar terms, each a sorted array of int64
+            milliseconds since J2000 in TT
+
+Both arrays are contiguous in event number, the newmoon of lunation k is at
+index k - first lunation number, so lookup by number is O(1). Events are
+numbered the same way as in astrostore.
+
+'''
+
+__license__ = 'BSD'
+__copyright__ = '2020, Chen Wei <weichen302@gmail.com>'
+__version__ = '0.0.3'
+
+from array import array
+import mmap
+import os
+import struct
+import sys
+
+__all__ = ['Catalog', 'write']
+
+MAGIC = b'LCAT'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sI16s16sqqqq')
+J2000 = 2451545.0
+MS_PER_DAY = 86400000.0
+
+
+def jd2ms(jd):
+    ''' JDTT to integer milliseconds since J2000 '''
+    return int(round((jd - J2000) * MS_PER_DAY))
+
+
+def ms2jd(ms):
+    ''' integer milliseconds since J2000 to JDTT '''
+    return J2000 + ms / MS_PER_DAY
+
+
+class EventArray(object):
+    ''' a sorted run of events numbered from first, backed by int64 ms '''
+
+    def __init__(self, first, ms):
+        self.first = first
+        self.ms = ms
+
+    def __len__(self):
+        return len(self.ms)
+
+    def __contains__(self, n):
+        return 0 <= n - self.first < len(self.ms)
+
+    def get(self, n):
+        ''' JDTT of event number n, None if not in catalog '''
+        if n not in self:
+            return None
+        return ms2jd(self.ms[n - self.first])
+
+
+class Catalog(object):
+    ''' read-only view of a catalog file
+
+    Attributes:
+        engine, version: the astronomical engine made the catalog
+        newmoons: EventArray keyed by lunation number
+        solarterms: EventArray keyed by year * 24 + angle / 15
+
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < HEADER.size:
+            self._mm.close()
+            raise ValueError('%s is truncated' % path)
+        (magic, fmtver, engine, version,
+         k0, nmcount, n0, stcount) = HEADER.unpack_from(self._mm)
+        if magic != MAGIC or fmtver != FORMAT_VERSION:
+            self._mm.close()
+            raise ValueError('%s is not a lunar calendar catalog' % path)
+        if len(self._mm) != HEADER.size + (nmcount + stcount) * 8:
+            self._mm.close()
+            raise ValueError('%s is truncated' % path)
+        self.engine = engine.rstrip(b'\0').decode('ascii')
+        self.version = version.rstrip(b'\0').decode('ascii')
+
+        self._views = []
+        nmstart = HEADER.size
+        ststart = nmstart + nmcount * 8
+        self.newmoons = EventArray(k0, self._int64s(nmstart, nmcount))
+        self.solarterms = EventArray(n0, self._int64s(ststart, stcount))
+
+    def _int64s(self, offset, count):
+        view = memoryview(self._mm)[offset:offset + count * 8]
+        if sys.byteorder == 'little':
+            self._views.append(view.cast('q'))
+            return self._views[-1]
+
+        # big-endian hosts pay for a swapped copy
+        arr = array('q', view.tobytes())
+        view.release()
+        arr.byteswap()
+        return arr
+
+    def newmoon(self, k):
+        ''' JDTT of newmoon of lunation k, None if not in catalog '''
+        return self.newmoons.get(k)
+
+    def solarterm(self, year, angle):
+        ''' JDTT of solar term, angle in degree is a multiple of 15, None if not
+        in catalog '''
+        return self.solarterms.get(year * 24 + angle // 15)
+
+    def close(self):
+        self.newmoons = self.solarterms = None
+        for view in self._views:
+            view.release()
+        self._mm.close()
+
+
+def write(path, engine, version, k0, newmoons, n0, solarterms):
+    ''' write a catalog file, it is replaced atomically
+
+    Args:
+        path: catalog file
+        engine, version: strings of the astronomical engine
+        k0: lunation number of the first newmoon
+        newmoons: list of JDTT of consecutive lunations
+        n0: number of the first solar term
+        solarterms: list of JDTT of consecutive solar terms
+    '''
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, engine.encode('ascii'),
+                         version.encode('ascii'), k0, len(newmoons),
+                         n0, len(solarterms))
+    body = array('q', [jd2ms(x) for x in newmoons])
+    body.extend(jd2ms(x) for x in solarterms)
+    if sys.byteorder != 'little':
+        body.byteswap()
+
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        body.tofile(f)
+    os.replace(tmp, path)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' persistent store of solved astronomical events
+
+Solar terms and newmoons found by the astronomical engine are saved to a
+SQLite database under the db directory, keyed by the kind of event, the number
+of the event, the engine and the engine version, so they survive the process.
+
+solarterm is a drop-in replacement of that in aa_full, it only evaluates the
+ephemeris when the event is not in the store. lunationnewmoon finds a newmoon
+by its lunation number, every lunation can be searched on its own.
+
+When a precomputed catalog made by the same engine exists, see astrocatalog,
+events it covers are read from it instead. Run this module to build one:
+
+    ./astrostore.py --start=-2000 --end=3000 --workers=4
+
+Events are numbered as:
+    solar term: year * 24 + angle / 15, the angle is in degree and a multiple
+                of 15, so (2014, 270) and (2015, -90) are the same event
+    newmoon: lunation number, 0 is the newmoon of 2000-01-06
+
+'''
+
+__license__ = 'BSD'
+__copyright__ = '2020, Chen Wei <weichen302@gmail.com>'
+__version__ = '0.0.3'
+
+from concurrent.futures import ProcessPoolExecutor
+import getopt
+import os
+import sqlite3
+import struct
+import sys
+import threading
+
+import aa_full
+from aa import g2jd
+import astrocatalog
+
+__all__ = ['solarterm', 'lunationnewmoon']
+
+APPDIR = os.path.abspath(os.path.dirname(__file__))
+# set to None to disable the store
+STORE_FILE = os.path.join(APPDIR, 'db', 'astro.sqlite')
+# set to None to ignore the catalog
+CATALOG_FILE = os.path.join(APPDIR, 'db', 'astrocatalog.bin')
+ENGINE = 'aa_full'
+VERSION = aa_full.__version__
+
+# the mean newmoon of lunation 0 and the mean synodic month, from A&A chap. 49
+NM_EPOCH = 2451550.09766
+MEAN_SYNODIC_MONTH = 29.530588861
+
+# one sqlite connection per thread, and the process opened it
+_LOCAL = threading.local()
+# the catalog is opened on first use, False if there is none
+_CATALOG = None
+
+
+def connect():
+    ''' open the store for current thread, None if the store is disabled or
+    can not be opened '''
+    conn = getattr(_LOCAL, 'conn', None)
+    # a forked worker inherits the connection of its parent, it opens its own
+    # and leaves the inherited one alone, closing it would upset the parent
+    if conn is not None and _LOCAL.pid != os.getpid():
+        conn = _LOCAL.conn = None
+    if conn is not None or STORE_FILE is None:
+        return conn
+
+    try:
+        os.mkdir(os.path.dirname(STORE_FILE))
+    except OSError:
+        pass
+
+    try:
+        conn = sqlite3.connect(STORE_FILE, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                        kind TEXT,
+                        n INTEGER,
+                        engine TEXT,
+                        version TEXT,
+                        jdtt REAL,
+                        PRIMARY KEY (kind, n, engine, version))
+                        WITHOUT ROWID''')
+        conn.commit()
+    except sqlite3.Error:
+        # a read-only checkout still computes, only without the store
+        return None
+
+    _LOCAL.conn, _LOCAL.pid = conn, os.getpid()
+    return conn
+
+
+def catalog():
+    ''' the catalog made by current engine, None if there isn't one '''
+    global _CATALOG
+    if _CATALOG is None:
+        _CATALOG = False
+        try:
+            cat = astrocatalog.Catalog(CATALOG_FILE)
+        except (OSError, TypeError, ValueError, struct.error):
+            # missing, truncated or not a catalog, the events are solved
+            return None
+        if cat.engine == ENGINE and cat.version == VERSION:
+            _CATALOG = cat
+        else:
+            cat.close()
+    return _CATALOG or None
+
+
+def get(kind, n):
+    ''' look up an event, return JDTT or None '''
+    cat = catalog()
+    if cat is not None:
+        events = cat.newmoons if kind == 'newmoon' else cat.solarterms
+        if n in events:
+            return events.get(n)
+
+    conn = connect()
+    if conn is None:
+        return None
+    sql = ('select jdtt from events '
+           'where kind=? and n=? and engine=? and version=?')
+    row = conn.execute(sql, (kind, n, ENGINE, VERSION)).fetchone()
+    return row[0] if row else None
+
+
+def put(kind, events):
+    ''' save events of the same kind
+    Arg:
+        kind: 'solarterm' or 'newmoon'
+        events: list of (n, jdtt)
+    '''
+    conn = connect()
+    if conn is None:
+        return
+    sql = ('insert or replace into events (kind,n,engine,version,jdtt) '
+           'values(?,?,?,?,?)')
+    try:
+        with conn:
+            conn.executemany(sql, [(kind, n, ENGINE, VERSION, jd)
+                                   for n, jd in events])
+    except sqlite3.OperationalError:
+        # e.g. database is locked for too long, the events can be solved
+        # again next time
+        pass
+
+
+def lunation(jd, margin=0.1):
+    ''' the lunation number of the mean newmoon nearest to jd, or None if jd
+    is too close to the middle of two mean newmoons to tell '''
+    k = (jd - NM_EPOCH) / MEAN_SYNODIC_MONTH
+    nearest = round(k)
+    if abs(k - nearest) > 0.5 - margin:
+        return None
+    return nearest
+
+
+def solarterm(year, angle):
+    ''' calculate Solar Term, see aa_full.solarterm
+
+    Args:
+        year: the year in integer
+        angle: degree of the solar term, in integer
+    Return:
+        time in JDTT
+
+        '''
+    if angle % 15:
+        return aa_full.solarterm(year, angle)
+
+    n = year * 24 + angle // 15
+    jd = get('solarterm', n)
+    if jd is None:
+        jd = aa_full.solarterm(year, angle)
+        put('solarterm', [(n, jd)])
+    return jd
+
+
+def lunationnewmoon(k):
+    ''' search the newmoon of lunation k
+
+    The true newmoon is less than a day off the mean newmoon, which is close
+    enough to start the search.
+
+    Arg:
+        k: lunation number
+    Return:
+        JDTT of newmoon
+
+    '''
+    jd = get('newmoon', k)
+    if jd is None:
+        jd = aa_full.newmoon(NM_EPOCH + k * MEAN_SYNODIC_MONTH)
+        put('newmoon', [(k, jd)])
+    return jd
+
+
+def termsolarterm(n):
+    ''' solar term of number n, see solarterm '''
+    return solarterm(n // 24, n % 24 * 15)
+
+
+def build_catalog(path, startyear, endyear, executor=None):
+    ''' solve every newmoon and every solar term the lunar calendars of
+    startyear to endyear are made of, and write them into a catalog
+
+    find_astro of a year searches the solar terms of angle -120 to 270, from
+    小雪 of the year before to 冬至, and 16 newmoons from a month before 大雪
+    of the year before. The terms of a year are numbered from its March
+    equinox, so the catalog starts 8 terms before startyear * 24, and ends
+    with the 冬至 of endyear, the last term in the Gregorian year.
+
+    Args:
+        path: the catalog file
+        startyear, endyear: integer years
+        executor: optional concurrent.futures.Executor to solve on
+    '''
+    k0 = lunation(g2jd(startyear - 1, 11, 1), margin=0)
+    k1 = lunation(g2jd(endyear - 1, 12, 1), margin=0) + 16
+    n0, n1 = startyear * 24 - 8, endyear * 24 + 19
+    mapper = executor.map if executor else map
+    # chunksize only matters for a process pool
+    kw = {'chunksize': 64} if executor else {}
+
+    newmoons = list(mapper(lunationnewmoon, range(k0, k1), **kw))
+    solarterms = list(mapper(termsolarterm, range(n0, n1), **kw))
+    try:
+        os.mkdir(os.path.dirname(os.path.abspath(path)))
+    except OSError:
+        pass
+    astrocatalog.write(path, ENGINE, VERSION, k0, newmoons, n0, solarterms)
+
+
+def main():
+    helpmsg = ('Usage: astrostore.py --start=year --end=year --workers=N '
+               '--output=file\n'
+               'build the catalog of newmoons and solar terms, e.g.\n'
+               '\tastrostore.py --start=-2000 --end=3000')
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['start=', 'end=', 'workers=', 'output=',
+                                    'help'])
+    except getopt.GetoptError as err:
+        print(str(err))
+        print(helpmsg)
+        sys.exit(2)
+
+    startyear, endyear = -2000, 3000
+    output = CATALOG_FILE
+    executor = None
+    for o, v in opts:
+        if o == '--start':
+            startyear = int(v)
+        elif o == '--end':
+            endyear = int(v)
+        elif o == '--workers':
+            executor = ProcessPoolExecutor(max_workers=int(v))
+        elif o == '--output':
+            output = v
+        elif 'h' in o:
+            sys.exit(helpmsg)
+
+    build_catalog(output, startyear, endyear, executor)
+    if executor:
+        executor.shutdown()
+    print('catalog from %d to %d saved to %s' % (startyear, endyear, output))
+
+
+if __name__ == "__main__":
+    main()
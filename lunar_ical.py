@@ -12,18 +12,42 @@ __license__ = 'BSD'
 __copyright__ = '2020, Chen Wei <weichen302@gmail.com>'
 __version__ = '0.0.3'
 
-from io import StringIO
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from datetime import datetime
-from datetime import timedelta
+from datetime import timezone
+from email.utils import parsedate_to_datetime
 import getopt
 import gzip
+import hashlib
+import io
+import json
 import os
 import re
 import sqlite3
 import sys
+import tarfile
+import threading
+import time
+import urllib.error
 import urllib.request
-import zlib
+import numpy as np
+from aa import jd2g
+from aa import jdftime
+from aa import jdptime
+import astrostore
 from lunarcalbase import cn_lunarcal
+# month names of lunarcalbase, every month code the engine makes has one
+from lunarcalbase import CN_MON as MONTH_NAME
+from lunarcalbase import DAY_DTYPE
+from lunarcalbase import HOLIDAYS
+from lunarcalbase import lunarcal_range
+from lunarcalbase import LRUCache
+from lunarcalbase import lunarcal_rows
+from lunarcalbase import mark_holiday
+from lunarcalbase import SOLARTERM_NAMES
 
 APPDIR = os.path.abspath(os.path.dirname(__file__))
 DB_FILE = os.path.join(APPDIR, 'db', 'lunarcal.sqlite')
@@ -31,8 +55,38 @@ RE_CAL = re.compile('(\d{4})年(\d{1,2})月(\d{1,2})日')
 #PROXY = {'http': 'http://localhost:8001'}
 PROXY = None
 URL = 'https://www.hko.gov.hk/tc/gts/time/calendar/text/files/T%dc.txt'
+# years of the HKO files
+HKO_YEARS = range(1901, 2101)
+# pages downloaded at the same time, and retries of a failed download
+FETCH_WORKERS = 8
+FETCH_RETRIES = 3
 OUTPUT = os.path.join(APPDIR, 'chinese_lunar_%s_%s.ics')
 OUTPUT_JIEQI = os.path.join(APPDIR, 'jieqi_tch_%s_%s.ics')
+# source of rows in the ical table, computed rows are tagged with the engine
+# and its version, rows made by an older engine are computed again
+SOURCE_HKO = 'HKO'
+SOURCE_COMPUTED = '%s-%s' % (astrostore.ENGINE, astrostore.VERSION)
+# PRAGMA user_version of db, 0 is the text schema keyed by ISO date, 1 may
+# have computed leap 11 and leap 12 saved as month 99 and 100
+SCHEMA_VERSION = 2
+# loading the HKO table trades durability for speed, the db stays in WAL
+# mode for concurrent readers
+BULK_PRAGMAS = ('synchronous=OFF', 'temp_store=MEMORY', 'cache_size=-65536')
+# connections of each thread, see connect
+_LOCAL = threading.local()
+# rows read from db a time when streaming
+ROWS_PER_FETCH = 4096
+# bump it when the VEVENT changes, so the fragments saved are rendered again
+FRAGMENT_VERSION = 1
+# bytes of the days of Gregorian years kept in memory for convert_dates
+YEAR_INDEX_BYTES = 32 * 1024 * 1024
+# DTSTAMP of reproducible builds for the years no HKO file with Last-Modified
+# covers, see data_version
+STABLE_DTSTAMP = '20140101T000000Z'
+# julian day number of 1582-10-15, the first day of Gregorian calendar, and
+# of the day before 0001-01-01 in proleptic Gregorian calendar
+GREGORIAN_JDN = 2299161
+ORDINAL_JDN = 1721425
 
 ICAL_HEAD = ('BEGIN:VCALENDAR\n'
              'PRODID:-//Chen Wei//Chinese Lunar Calendar//EN\n'
@@ -70,6 +124,8 @@ CN_MON = {'正月': 1, '二月': 2, '三月': 3, '四月': 4,
           '閏五月': 105, '閏六月': 106, '閏七月': 107, '閏八月': 108,
           '閏九月': 109, '閏十月': 110, '閏十一月': 111, '閏十二月': 112}
 
+DAY_NAME = dict((v, k) for k, v in CN_DAY.items())
+
 GAN = ('庚', '辛', '壬', '癸', '甲', '乙', '丙', '丁', '戊', '己')
 ZHI = ('申', '酉', '戌', '亥', '子', '丑',
        '寅', '卯', '辰', '巳', '午', '未')
@@ -79,260 +135,1166 @@ SX = ('猴', '鸡', '狗', '猪', '鼠', '牛',
 
 def initdb():
     try:
-        print('creating db dir')
         os.mkdir(os.path.join(APPDIR, 'db'))
+        print('db dir created', file=sys.stderr)
     except OSError:
         pass
 
     conn = sqlite3.connect(DB_FILE)
     db = conn.cursor()
+    db.execute('PRAGMA journal_mode=WAL')
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    columns = [x[1] for x in db.execute('PRAGMA table_info(ical)')]
+    if columns and version < 1:
+        print('upgrading %s' % DB_FILE, file=sys.stderr)
+        db.execute('ALTER TABLE ical RENAME TO ical_text')
+
+    # one row per day, keyed by julian day number. lmonth is 1 to 12, leap is
+    # 1 in a leap month, term and hcode index SOLARTERM_NAMES and HOLIDAYS,
+    # 0 for none
     db.execute('''CREATE TABLE IF NOT EXISTS ical (
-                    id INTEGER PRIMARY KEY,
-                    date TEXT UNIQUE,
-                    lunardate TEXT,
-                    holiday TEXT,
-                    jieqi TEXT)''')
+                    jdn INTEGER PRIMARY KEY,
+                    lyear INTEGER,
+                    lmonth INTEGER,
+                    lday INTEGER,
+                    leap INTEGER,
+                    term INTEGER,
+                    hcode INTEGER,
+                    source TEXT)
+                    WITHOUT ROWID''')
+    db.execute('''CREATE INDEX IF NOT EXISTS ical_month
+                    ON ical (source, lday, jdn)''')
+    # years of computed rows saved in ical table
+    db.execute('''CREATE TABLE IF NOT EXISTS computed (
+                    year INTEGER PRIMARY KEY,
+                    source TEXT)''')
+    # HKO files saved in ical table, to refresh only the changed ones
+    db.execute('''CREATE TABLE IF NOT EXISTS hko_files (
+                    year INTEGER PRIMARY KEY,
+                    etag TEXT,
+                    modified TEXT,
+                    sha256 TEXT)''')
+    # VEVENTs of whole Gregorian years, see generate
+    db.execute('''CREATE TABLE IF NOT EXISTS fragments (
+                    year INTEGER,
+                    variant TEXT,
+                    version TEXT,
+                    body TEXT,
+                    PRIMARY KEY (year, variant))
+                    WITHOUT ROWID''')
+
+    if columns and version < 1:
+        migratedb(db, columns)
+    elif columns and version < 2:
+        db.execute('UPDATE ical SET lmonth=lmonth-88, leap=1 '
+                   'WHERE lmonth IN (99, 100)')
+    db.execute('PRAGMA user_version=%d' % SCHEMA_VERSION)
     conn.commit()
     db.close()
 
 
+def migratedb(db, columns):
+    ''' move HKO rows of the text schema, renamed to ical_text, into the ical
+    table. Computed rows are dropped, they are computed and saved again when
+    asked. Holidays are marked again. '''
+    sql, args = 'select date, lunardate, jieqi from ical_text', ()
+    if 'source' in columns:
+        sql, args = sql + ' where source=?', (SOURCE_HKO, )
+    records = [(isojdn(r[0]), r[1], r[2])
+               for r in db.execute(sql + ' order by date', args)]
+    if records:
+        save_days(db, mark_holiday(label_hko(records)), SOURCE_HKO)
+    db.execute('DROP TABLE ical_text')
+    db.execute('DELETE FROM computed')
+
+
 def printjieqi():
-    sql = 'select jieqi from ical where jieqi NOT NULL limit 28'
+    sql = 'select term from ical where term>0 order by jdn limit 28'
     res = query_db(sql)
     d = -75
     for row in res:
-        print("%d: u'%s', " % (d, row[0]))
+        print("%d: u'%s', " % (d, SOLARTERM_NAMES[row[0]]))
         d += 15
 
 
+def connect(readonly=True):
+    ''' the connection of current thread to DB_FILE, it is kept open and
+    caches its prepared statements. A read-only connection is opened in
+    mode=ro, in WAL mode readers neither block each other nor the writer.
+    Rows of the read-only connection are sqlite3.Row, those of the other are
+    plain tuples, as of the connections passed to the writers.
+    '''
+    conns = getattr(_LOCAL, 'conns', None)
+    if conns is not None and _LOCAL.pid != os.getpid():
+        # inherited by a forked worker, those belong to the parent
+        conns = None
+    if conns is None or _LOCAL.path != DB_FILE:
+        for conn in (conns or {}).values():
+            conn.close()
+        conns = _LOCAL.conns = {}
+        _LOCAL.path, _LOCAL.pid = DB_FILE, os.getpid()
+
+    if readonly not in conns:
+        if readonly:
+            uri = 'file:%s?mode=ro' % urllib.request.pathname2url(DB_FILE)
+            conn = sqlite3.connect(uri, uri=True, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+        else:
+            conn = sqlite3.connect(DB_FILE, timeout=30, cached_statements=256)
+        conns[readonly] = conn
+    return conns[readonly]
+
+
 def query_db(query, args=(), one=False):
     ''' wrap the db query, fetch into one step '''
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    db = conn.cursor()
-    cur = db.execute(query, args)
-    rv = cur.fetchall()
-    cur.close()
+    rv = connect().execute(query, args).fetchall()
     return (rv[0] if rv else None) if one else rv
 
 
-def parse_hko(pageurl):
-    ''' parse lunar calendar from hk Obs
-    Args: pageurl
+def isojdn(isodate):
+    ''' julian day number of a date in ISO format
+    Raise:
+        ValueError if it is not a date, e.g. 2031-02-30, or a day of 1582
+        dropped by the Gregorian calendar
+    '''
+    jdn = int(jdptime(isodate, '%y-%m-%d') + 0.5)
+    # jdptime carries days and months over, 2031-02-30 is 2031-03-02
+    if jdnymd(jdn) != tuple(int(x) for x in isodate.split('-')):
+        raise ValueError('invalid date %s' % isodate)
+    return jdn
+
+
+def jdniso(jdn):
+    ''' date in ISO format of a julian day number '''
+    return jdftime(jdn - 0.5, '%y-%m-%d', ut=False)
+
+
+def label_hko(records, month=0):
+    ''' number the lunar month and day of days parsed from HKO
+
+    Args:
+        records: list of (jdn, lunardate, jieqi) in order, the lunardate is
+                 the name of month on the first day of a month, otherwise the
+                 name of day
+        month: month code of the day before records, 0 if unknown
+    Return:
+        array of DAY_DTYPE, holiday is not marked
+    '''
+    days = np.zeros(len(records), dtype=DAY_DTYPE)
+    day = 0
+    first = None
+    for i, (jdn, lunardate, jieqi) in enumerate(records):
+        if lunardate in CN_MON:
+            month, day = CN_MON[lunardate], 1
+            if first is None:
+                first = i
+        else:
+            # a few days are labeled by weekday in HK OBS data, they follow
+            # the day before, see post_process
+            day = CN_DAY.get(lunardate, day + 1)
+        term = SOLARTERM_NAMES.index(jieqi) if jieqi else 0
+        days[i] = (jdn, month, day, term, 0)
+
+    # days before the first month start are in the month before it
+    if first and not days['month'][0]:
+        code = days['month'][first]
+        prev = code - 100 if code > 100 else (code - 2) % 12 + 1
+        days['month'][:first] = prev
+    return days
+
+
+def mark_lunaryear(days):
+    ''' lunar year of array of DAY_DTYPE, a lunar year starts at 正月初一 and
+    is numbered by the Gregorian year it starts in
+    Return:
+        array of integer years
+    '''
+    if not len(days):
+        return np.zeros(0, dtype=int)
+    year, month = jd2g(days['jdn'][0] - 0.5)[:2]
+    if days['month'][0] % 100 >= 11 and month <= 2:
+        year -= 1
+    newyear = (days['month'] == 1) & (days['day'] == 1)
+    # the year of the first day is known, a 正月初一 there is counted already
+    return year + np.cumsum(newyear) - newyear[0]
+
+
+def save_days(db, days, source):
+    ''' write array of DAY_DTYPE to ical table
+    Args:
+        db: sqlite3 connection or cursor
+        days: array of DAY_DTYPE in order
+        source: SOURCE_HKO or SOURCE_COMPUTED
+    '''
+    sql = ('insert or replace into ical '
+           '(jdn,lyear,lmonth,lday,leap,term,hcode,source) '
+           'values(?,?,?,?,?,?,?,?)')
+    lyear = mark_lunaryear(days).tolist()
+    db.executemany(sql, [(jdn, y, month % 100, day, int(month > 100), jieqi,
+                          holiday, source)
+                         for y, (jdn, month, day, jieqi, holiday)
+                         in zip(lyear, days.tolist())])
+
+
+def query_days(first, last, source):
+    ''' read days between two julian day numbers from ical table
     Return:
-          a string contains all posts'''
+        array of DAY_DTYPE
+    '''
+    sql = ('select jdn, lmonth + 100 * leap, lday, term, hcode from ical '
+           'where jdn>=? and jdn<=? and source=? order by jdn')
+    rows = [tuple(r) for r in query_db(sql, (first, last, source))]
+    return np.array(rows, dtype=DAY_DTYPE)
 
-    print('grabbing and parsing %s' % pageurl)
-    with urllib.request.urlopen(pageurl) as f:
-        html = f.read()
-        lines = html.decode('utf-8').split('\n')
 
-    sql_nojq = ('insert or replace into ical (date,lunardate) '
-                'values(?,?) ')
-    sql_jq = ('insert or replace into ical (date,lunardate,jieqi) '
-              'values(?,?,?) ')
-    conn = sqlite3.connect(DB_FILE)
-    db = conn.cursor()
-    for line in lines:
+def iter_query_days(first, last, source):
+    ''' read days between two julian day numbers from ical table, with one
+    query fetched ROWS_PER_FETCH rows a time
+    Return:
+        iterator of arrays of DAY_DTYPE
+    '''
+    sql = ('select jdn, lmonth + 100 * leap, lday, term, hcode from ical '
+           'where jdn>=? and jdn<=? and source=? order by jdn')
+    cur = connect().execute(sql, (first, last, source))
+    try:
+        while True:
+            rows = cur.fetchmany(ROWS_PER_FETCH)
+            if not rows:
+                break
+            yield np.array([tuple(r) for r in rows], dtype=DAY_DTYPE)
+    finally:
+        cur.close()
+
+
+def fetch_hko(pageurl, etag=None, modified=None):
+    ''' download a page from hk Obs, retry with backoff on network errors.
+    The request is conditional if the ETag or Last-Modified of the last
+    download is given.
+    Args:
+        pageurl
+        etag, modified: optional ETag and Last-Modified headers
+    Return:
+        tuple of (page in a string, ETag, Last-Modified), page is None if it
+        is not modified
+    '''
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+    req = urllib.request.Request(pageurl, headers=headers)
+    for retry in range(FETCH_RETRIES + 1):
+        try:
+            with urllib.request.urlopen(req, timeout=60) as f:
+                return (f.read().decode('utf-8'), f.headers.get('ETag'),
+                        f.headers.get('Last-Modified'))
+        except urllib.error.HTTPError as err:
+            if err.code == 304:
+                return None, etag, modified
+            if err.code < 500 or retry == FETCH_RETRIES:
+                raise
+            print('retry %s: %s' % (pageurl, err), file=sys.stderr)
+        except (urllib.error.URLError, OSError) as err:
+            if retry == FETCH_RETRIES:
+                raise
+            print('retry %s: %s' % (pageurl, err), file=sys.stderr)
+        time.sleep(2 ** retry)
+
+
+def fetch_pages(years, mirror=None, known=None):
+    ''' fetch HKO files of years, FETCH_WORKERS at a time
+    Args:
+        years: list of integer years
+        mirror: optional directory or tarball of the files, read instead of
+                downloading
+        known: optional dictionary of year to (ETag, Last-Modified) of the
+               last download, to send conditional requests
+    Return:
+        list of (page, ETag, Last-Modified) in the order of years, see
+        fetch_hko
+    '''
+    urls = [URL % y for y in years]
+    if mirror:
+        print('reading HKO data from %s' % mirror, file=sys.stderr)
+        pages = read_mirror(mirror, [os.path.basename(x) for x in urls])
+        return [(x, None, None) for x in pages]
+
+    known = known or {}
+    print('grabbing HKO data from %s' % os.path.dirname(urls[0]),
+          file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        futures = [pool.submit(fetch_hko, url, *known.get(y, (None, None)))
+                   for y, url in zip(years, urls)]
+        return [x.result() for x in futures]
+
+
+def read_mirror(mirror, names):
+    ''' read pages from a local mirror of hk Obs
+    Args:
+        mirror: a directory or a tarball holds the files, e.g. T1901c.txt
+        names: list of file names
+    Return:
+        list of pages in the same order as names
+    '''
+    if os.path.isdir(mirror):
+        pages = []
+        for name in names:
+            with open(os.path.join(mirror, name), 'rb') as f:
+                pages.append(f.read().decode('utf-8'))
+        return pages
+
+    pages = {}
+    with tarfile.open(mirror) as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if member.isfile() and name in names:
+                pages[name] = tar.extractfile(member).read().decode('utf-8')
+    missing = [x for x in names if x not in pages]
+    if missing:
+        raise OSError('%s not in %s' % (', '.join(missing), mirror))
+    return [pages[x] for x in names]
+
+
+def parse_hko(page):
+    ''' parse lunar calendar from hk Obs
+    Args: page, text of a yearly file
+    Return:
+          list of (jdn, lunardate, jieqi), jieqi is None if there isn't one
+    '''
+    records = []
+    for line in page.split('\n'):
         m = RE_CAL.match(line)
         if m:
             fds = line.split()
-            # add leading zero to month and day
-            if len(m.group(2)) == 1:
-                str_m = '0%s' % m.group(2)
-            else:
-                str_m = m.group(2)
-            if len(m.group(3)) == 1:
-                str_d = '0%s' % m.group(3)
-            else:
-                str_d = m.group(3)
-
-            dt = '%s-%s-%s' % (m.group(1), str_m, str_d)
+            jdn = isojdn('%s-%s-%s' % m.groups())
             if len(fds) > 3:  # last field is jieqi
-                db.execute(sql_jq, (dt, fds[1], fds[3]))
+                records.append((jdn, fds[1], fds[3]))
             else:
-                db.execute(sql_nojq, (dt, fds[1]))
-    conn.commit()
+                records.append((jdn, fds[1], None))
+    return records
+
+
+def save_file(db, year, page, etag, modified):
+    ''' remember the ETag, Last-Modified and SHA-256 of a HKO file '''
+    sha = hashlib.sha256(page.encode('utf-8')).hexdigest()
+    db.execute('insert or replace into hko_files (year,etag,modified,sha256) '
+               'values(?,?,?,?)', (year, etag, modified, sha))
+    return sha
+
+
+def update_cal(mirror=None):
+    ''' fetch lunar calendar from HongKong Obs, parse it and save to db.
+
+    All years are parsed first, then loaded, fixed and marked with holidays
+    in one transaction.
+
+    Arg:
+        mirror: optional directory or tarball of the files, read instead of
+                downloading
+    '''
+    years = list(HKO_YEARS)
+    fetched = fetch_pages(years, mirror)
+
+    records = []
+    for page, etag, modified in fetched:
+        records.extend(parse_hko(page))
+
+    conn = sqlite3.connect(DB_FILE)
+    # the db can be built again if the load is interrupted
+    for pragma in BULK_PRAGMAS:
+        conn.execute('PRAGMA %s' % pragma)
+    with conn:
+        save_days(conn, label_hko(records), SOURCE_HKO)
+        post_process(conn)  # fix error in HK data
+        update_holiday(conn)
+        for year, (page, etag, modified) in zip(years, fetched):
+            save_file(conn, year, page, etag, modified)
+    conn.close()
+    print('%d days saved to %s' % (len(records), DB_FILE), file=sys.stderr)
+
+
+def reload_year(db, records):
+    ''' replace days of a HKO file in db
+    Args:
+        db: sqlite3 connection, the caller commits
+        records: days parsed from the file, see parse_hko
+    '''
+    first, last = records[0][0], records[-1][0]
+    sql = 'select lmonth + 100 * leap from ical where source=? and jdn=?'
+    row = db.execute(sql, (SOURCE_HKO, first - 1)).fetchone()
+    days = label_hko(records, row[0] if row else 0)
+    db.execute('delete from ical where source=? and jdn>=? and jdn<=?',
+               (SOURCE_HKO, first, last))
+    save_days(db, days, SOURCE_HKO)
+
+    # the next file starts in the last month of this one, see label_hko
+    lyear = int(mark_lunaryear(days)[-1])
+    month = int(days['month'][-1])
+    sql = ('update ical set lyear=?, lmonth=?, leap=? '
+           'where source=? and jdn>? and jdn<'
+           '(select min(jdn) from ical where source=? and lday=1 and jdn>?)')
+    db.execute(sql, (lyear, month % 100, int(month > 100), SOURCE_HKO, last,
+                     SOURCE_HKO, last))
+
+
+def refresh_cal(mirror=None):
+    ''' fetch HKO files again, with conditional requests, and save the years
+    changed since the last time to db
+
+    Arg:
+        mirror: optional directory or tarball of the files, read instead of
+                downloading
+    Return:
+        list of Gregorian years changed
+    '''
+    years = list(HKO_YEARS)
+    sql = 'select year, etag, modified, sha256 from hko_files'
+    known = dict((r[0], tuple(r[1:])) for r in query_db(sql))
+    fetched = fetch_pages(years, mirror,
+                          dict((y, x[:2]) for y, x in known.items()))
+
+    changed = []
+    conn = connect(readonly=False)
+    with conn:
+        for year, (page, etag, modified) in zip(years, fetched):
+            if page is None:
+                continue
+            if mirror and year in known:
+                # a mirror has no headers, keep those of the last download
+                etag, modified = known[year][:2]
+            sha = save_file(conn, year, page, etag, modified)
+            if year in known and known[year][2] == sha:
+                continue
+            records = parse_hko(page)
+            reload_year(conn, records)
+            # 除夕 and 寒食 of the day before the file depend on it, and the
+            # next file starts in the last month of this one
+            post_process(conn, records[0][0], records[-1][0])
+            update_holiday(conn, records[0][0] - 1, records[-1][0] + 30)
+            changed.append(year)
+
+    if changed:
+        MONTH_INDEX.clear()
+        print('HKO data changed: %s' % ' '.join(str(x) for x in changed),
+              file=sys.stderr)
+    else:
+        print('HKO data not changed', file=sys.stderr)
+    return changed
+
+
+def hko_months():
+    ''' the first and the last lunar month start in the HKO table, the table
+    has whole lunar months from the first up to the day before the last.
+    Return:
+        tuple of two julian day numbers, or None if the table is empty
+    '''
+    sql = 'select min(jdn), max(jdn) from ical where source=? and lday=1'
+    row = query_db(sql, (SOURCE_HKO,), one=True)
+    if row is None or row[0] is None:
+        return None
+    return row[0], row[1]
+
+
+def materialize(year, executor=None):
+    ''' compute Lunar Calendar of a Gregorian year and save it to db, rows
+    of the year computed by another engine are replaced.
+    Return:
+        array of DAY_DTYPE of the year
+    '''
+    days = cn_lunarcal(year, executor)
+    try:
+        conn = connect(readonly=False)
+        with conn:
+            conn.execute('delete from ical where jdn>=? and jdn<=? and '
+                         'source!=?', (int(days['jdn'][0]),
+                                       int(days['jdn'][-1]), SOURCE_HKO))
+            save_days(conn, days, SOURCE_COMPUTED)
+            conn.execute('insert or replace into computed (year,source) '
+                         'values(?,?)', (year, SOURCE_COMPUTED))
+    except sqlite3.OperationalError:
+        # e.g. a read-only checkout or the db is locked for too long, the
+        # year is computed again next time
+        pass
+    return days
+
+
+def compute_days(first, last, executor=None):
+    ''' Lunar Calendar computed by astronomical algorithm, from julian day
+    number first to last.
+
+    Whole Gregorian years are saved to db by current engine the first time
+    and read back later, the partial years at either end are computed for
+    the days asked unless the year is in db already.
+
+    Return:
+        iterator of arrays of DAY_DTYPE, one for each Gregorian year
+    '''
+    sql_year = 'select year from computed where source=? and year>=? and year<=?'
+    startyear, endyear = jd2g(first - 0.5)[0], jd2g(last - 0.5)[0]
+    saved = set(x[0] for x in query_db(sql_year, (SOURCE_COMPUTED, startyear,
+                                                  endyear)))
+    for year in range(startyear, endyear + 1):
+        ystart = isojdn('%d-01-01' % year)
+        yend = isojdn('%d-12-31' % year)
+        lo, hi = max(first, ystart), min(last, yend)
+        if year in saved:
+            yield query_days(lo, hi, SOURCE_COMPUTED)
+        elif lo == ystart and hi == yend:
+            yield materialize(year, executor)
+        else:
+            yield lunarcal_range(jdniso(lo), jdniso(hi))
+
+
+def check_seam(hko, computed):
+    ''' warn if HKO and the astronomical algorithm disagree on the day where
+    the two sources meet, both are array of DAY_DTYPE of that day '''
+    hko, computed = next(lunarcal_rows(hko)), next(lunarcal_rows(computed))
+    if (hko['month'], hko['day']) != (computed['month'], computed['day']):
+        print('warning: %s is %s by HKO, but %s by astronomical algorithm' %
+              (hko['date'], hko['lunardate'], computed['lunardate']),
+              file=sys.stderr)
+
+
+def iter_days(start, end, executor=None):
+    ''' Lunar Calendar from start to end, in pieces.
+
+    Whole lunar months in the HKO table are read from db, the days before and
+    after them are computed by astronomical algorithm. The two sources meet at
+    a lunar month start, so a lunar month, and its leap flag, is never labeled
+    half by one source and half by the other. The month start at the seam is
+    solved by both and compared.
+
+    Args:
+        start and end date in ISO format, like 2010-12-31
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+    Return:
+        iterator of arrays of DAY_DTYPE, the days are consecutive
+    '''
+    first, last = isojdn(start), isojdn(end)
+    span = hko_months()
+    if span is None:
+        print('compute Lunar Calendar by astronomical algorithm ',
+              file=sys.stderr)
+        return compute_days(first, last, executor)
+    return merge_days(first, last, span, executor)
+
+
+def fetch_days(start, end, executor=None):
+    ''' Lunar Calendar from start to end in one array of DAY_DTYPE, see
+    iter_days '''
+    parts = list(iter_days(start, end, executor))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=DAY_DTYPE)
+
+
+def merge_days(first, last, span, executor=None):
+    ''' days from HKO within span, computed days outside, see iter_days '''
+    hkofirst, hkolast = span
+    if first < hkofirst:
+        print('compute Lunar Calendar before %s by astronomical algorithm '
+              % jdniso(hkofirst), file=sys.stderr)
+        # hold back a year to drop the seam from the last one
+        prev = None
+        for days in compute_days(first, min(last, hkofirst), executor):
+            if prev is not None:
+                yield prev
+            prev = days
+        if prev['jdn'][-1] == hkofirst:
+            check_seam(query_days(hkofirst, hkofirst, SOURCE_HKO), prev[-1:])
+            prev = prev[:-1]
+        yield prev
+
+    if first <= hkolast and last >= hkofirst:
+        print('use Lunar Calendar from HKO', file=sys.stderr)
+        # the seam at hkolast is left to computed days
+        hi = hkolast - 1 if last >= hkolast else last
+        for days in iter_query_days(max(first, hkofirst), hi, SOURCE_HKO):
+            yield days
+
+    if last >= hkolast:
+        print('compute Lunar Calendar since %s by astronomical algorithm '
+              % jdniso(hkolast), file=sys.stderr)
+        seam = first <= hkolast
+        for days in compute_days(max(first, hkolast), last, executor):
+            if seam:
+                check_seam(query_days(hkolast, hkolast, SOURCE_HKO), days[:1])
+                seam = False
+            yield days
+
+
+def jdnymd(jdn):
+    ''' year, month and day of a julian day number, in Julian calendar
+    before 1582-10-15 as aa.jd2g '''
+    if jdn >= GREGORIAN_JDN:
+        d = date.fromordinal(jdn - ORDINAL_JDN)
+        return d.year, d.month, d.day
+    y, m, d = jd2g(jdn - 0.5)
+    return y, m, int(d)
+
+
+def full_summaries(days, lyears):
+    ''' summaries of every day, the month start has the ganzhi of lunar year
+    Args:
+        days: array of DAY_DTYPE
+        lyears: list of lunar years of days, see mark_lunaryear
+    Return:
+        iterator of (jdn, summary)
+    '''
+    lyear, yearname = None, None
+    for (jdn, month, day, jieqi, holiday), y in zip(days.tolist(), lyears):
+        if day == 1:
+            # days are in order, the name changes once a lunar year
+            if y != lyear:
+                lyear, yearname = y, ganzhi(y)
+            ld = ['%s%s' % (yearname, MONTH_NAME[month])]
+        else:
+            ld = [DAY_NAME[day]]
+        if holiday:
+            ld.append(HOLIDAYS[holiday])
+        if jieqi:
+            ld.append(SOLARTERM_NAMES[jieqi])
+        yield jdn, ' '.join(ld)
+
+
+def jieqi_summaries(days, lyears):
+    ''' summaries of days of Jieqi and Traditional Chinese holidays only,
+    see full_summaries '''
+    days = days[(days['jieqi'] > 0) | (days['holiday'] > 0)]
+    for jdn, month, day, jieqi, holiday in days.tolist():
+        ld = []
+        if holiday:
+            ld.append(HOLIDAYS[holiday])
+        if jieqi:
+            ld.append(SOLARTERM_NAMES[jieqi])
+        yield jdn, ' '.join(ld)
+
+
+# the calendars can be made, name: summaries of the days in the calendar
+VARIANTS = {'full': full_summaries,
+            'jieqi': jieqi_summaries}
+
 
+def vevent(utcstamp, jdn, summary):
+    ''' VEVENT of a whole day event '''
+    y, m, d = jdnymd(jdn)
+    uid = '%d-%02d-%02d-lc@infinet.github.io' % (y, m, d)
+    return ICAL_SEC % (utcstamp, uid, '%04d%02d%02d' % (y, m, d),
+                       '%04d%02d%02d' % jdnymd(jdn + 1), summary)
 
-def update_cal():
-    ''' fetch lunar calendar from HongKong Obs, parse it and save to db'''
-    for y in range(1901, 2101):
-        parse_hko(URL % y)
 
+def open_ical(f, name, gz=False, mtime=None):
+    ''' wrap a file opened in binary mode for text, gzip compressed if gz,
+    the gzip header has the file name of name, and mtime, the current time if
+    None. f is still to be closed after the wrapper. '''
+    if gz:
+        f = gzip.GzipFile(name, 'wb', mtime=mtime, fileobj=f)
+    return io.TextIOWrapper(f, encoding='utf-8')
 
-def gen_cal(start, end, fp):
+
+def write_sha256(path):
+    ''' write the sha256 of a file to path.sha256, in the format of
+    sha256sum, return the hex digest '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    with open(path + '.sha256', 'w') as f:
+        f.write('%s  %s\n' % (h.hexdigest(), os.path.basename(path)))
+    return h.hexdigest()
+
+
+class IcalSink(object):
+    ''' an iCalendar output of generate, a file is written to a temporary
+    file aside, and replaces fp only when the calendar is complete
+
+    Args:
+        fp: path to output file, or a file object opened in text mode, e.g.
+            sys.stdout
+        variant: name in VARIANTS, which days are in the calendar
+        gz: compress the output to fp.gz, fp must be a path
+        keepplain: with gz, also write the uncompressed fp in the same pass
+        stable: reproducible files, the gzip header has no time, and the
+                sha256 of each file is written to a .sha256 file aside
+    Attributes:
+        paths: list of files written
+        digests: dict of path: sha256 of the file, when stable
+    '''
+
+    def __init__(self, fp, variant='full', gz=False, keepplain=False,
+                 stable=False):
+        if not isinstance(fp, str) and gz:
+            raise ValueError('gzip output needs a path')
+        if variant not in VARIANTS:
+            raise ValueError('unknown variant %s' % variant)
+        self.fp = fp
+        self.variant = variant
+        self.stable = stable
+        self.digests = {}
+        if not isinstance(fp, str):
+            self.paths = [fp]
+        else:
+            self.paths = [fp + '.gz'] if gz else [fp]
+            if gz and keepplain:
+                self.paths.insert(0, fp)
+        self.outs = []
+        self.files = []
+
+    def open(self):
+        for path in self.paths:
+            if not isinstance(path, str):
+                self.outs.append(path)
+                continue
+            self.files.append(open(path + '.tmp', 'wb'))
+            self.outs.append(open_ical(self.files[-1], path,
+                                       path.endswith('.gz'),
+                                       0 if self.stable else None))
+        for out in self.outs:
+            out.write(ICAL_HEAD)
+
+    def write(self, events):
+        ''' write VEVENTs, each begins with a newline '''
+        for out in self.outs:
+            out.write(events)
+
+    def close(self, complete=True):
+        ''' end the calendar, or just close the files if not complete '''
+        for out in self.outs:
+            if complete:
+                out.write('\n')
+                out.write(ICAL_END)
+            if out is not self.fp:
+                out.close()
+        for f in self.files:
+            f.close()
+        self.outs, self.files = [], []
+        for path in self.paths:
+            if not isinstance(path, str):
+                continue
+            if not complete:
+                try:
+                    os.remove(path + '.tmp')
+                except OSError:
+                    pass
+                continue
+            os.replace(path + '.tmp', path)
+            if self.stable:
+                self.digests[path] = write_sha256(path)
+
+
+def data_version(year, stable=False):
+    ''' version of the data the days of a Gregorian year are made of, it
+    changes with the HKO files of the year and the years next to it, with the
+    astronomical engine, and with the format of VEVENT
+
+    Args:
+        year: Gregorian year
+        stable: also derive a DTSTAMP from the data, it is the newest
+                Last-Modified of the HKO files, or STABLE_DTSTAMP
+    Return:
+        (version, dtstamp), dtstamp is None unless stable
+    '''
+    sql = ('select year, sha256, modified from hko_files '
+           'where year>=? and year<=? order by year')
+    rows = query_db(sql, (year - 1, year + 1))
+    parts = [str(FRAGMENT_VERSION), SOURCE_COMPUTED]
+    parts.extend('%d:%s' % (r[0], r[1]) for r in rows)
+    stamp = None
+    if stable:
+        stamp = STABLE_DTSTAMP
+        modified = []
+        for r in rows:
+            try:
+                modified.append(parsedate_to_datetime(r[2]))
+            except (TypeError, ValueError):
+                pass
+        if modified:
+            stamp = max(modified).astimezone(timezone.utc).strftime(
+                '%Y%m%dT%H%M%SZ')
+        # fragments of stable builds are not mixed with the others
+        parts.append(stamp)
+    version = hashlib.sha1(' '.join(parts).encode('utf-8')).hexdigest()
+    return version, stamp
+
+
+def get_fragment(year, variant, version):
+    ''' VEVENTs of a whole Gregorian year rendered before, None if there
+    isn't one of the version '''
+    sql = 'select body from fragments where year=? and variant=? and version=?'
+    row = query_db(sql, (year, variant, version), one=True)
+    return row[0] if row else None
+
+
+def put_fragments(year, version, bodies):
+    ''' save VEVENTs of a whole Gregorian year, replace the older version
+    Args:
+        bodies: dict of variant: VEVENTs of the year
+    '''
+    sql = ('insert or replace into fragments (year,variant,version,body) '
+           'values(?,?,?,?)')
+    try:
+        conn = connect(readonly=False)
+        with conn:
+            conn.executemany(sql, [(year, variant, version, body)
+                                   for variant, body in bodies.items()])
+    except sqlite3.OperationalError:
+        # a cache only, the year is rendered again next time
+        pass
+
+
+def year_segments(first, last):
+    ''' split julian day number first to last at the Gregorian new years
+    Return:
+        list of (first, last, year, whole), whole is False for a part of the
+        year
+    '''
+    segments = []
+    for year in range(jdnymd(first)[0], jdnymd(last)[0] + 1):
+        ystart = isojdn('%d-01-01' % year)
+        yend = isojdn('%d-12-31' % year)
+        lo, hi = max(first, ystart), min(last, yend)
+        segments.append((lo, hi, year, lo == ystart and hi == yend))
+    return segments
+
+
+def segment_days(parts, segments):
+    ''' regroup consecutive days into segments
+    Args:
+        parts: iterator of arrays of DAY_DTYPE
+        segments: list of (first, last, ...) covers the days in parts
+    Return:
+        iterator of (segment, array of DAY_DTYPE of the segment)
+    '''
+    segments = iter(segments)
+    segment = next(segments)
+    buf = []
+    for days in parts:
+        while len(days):
+            n = np.searchsorted(days['jdn'], segment[1], side='right')
+            buf.append(days[:n])
+            days = days[n:]
+            if len(days):
+                yield segment, np.concatenate(buf)
+                buf = []
+                segment = next(segments)
+    if buf:
+        yield segment, np.concatenate(buf)
+
+
+def render_days(days, variant, utcstamp):
+    ''' VEVENTs of days in one string, each begins with a newline '''
+    lyears = mark_lunaryear(days).tolist()
+    return ''.join('\n' + vevent(utcstamp, jdn, summary)
+                   for jdn, summary in VARIANTS[variant](days, lyears))
+
+
+def generate(start, end, sinks, executor=None, cache=True, stable=False):
+    ''' generate calendars from start to end, one pass over the days feeds
+    all the sinks.
+
+    The VEVENTs of whole Gregorian years are saved to db, a later run reuses
+    them as long as the data of the year stays the same, see data_version. A
+    rolling window only renders the year newly entered.
+
+    Args:
+        start and end date in ISO format, like 2010-12-31
+        sinks: list of IcalSink
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+        cache: False to render every year again
+        stable: DTSTAMP is derived from the data instead of the current
+                time, so the same data always makes the same calendar
+    '''
+    utcstamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    variants = set(sink.variant for sink in sinks)
+
+    def render(run):
+        ''' render a run of consecutive segments not in cache '''
+        parts = iter_days(jdniso(run[0][0]), jdniso(run[-1][1]), executor)
+        for (lo, hi, year, whole), days in segment_days(parts, run):
+            version, stamp = data_version(year, stable)
+            bodies = dict((v, render_days(days, v, stamp or utcstamp))
+                          for v in variants)
+            if whole and cache:
+                put_fragments(year, version, bodies)
+            for sink in sinks:
+                sink.write(bodies[sink.variant])
+
+    complete = False
+    for sink in sinks:
+        sink.open()
+    try:
+        run = []
+        for segment in year_segments(isojdn(start), isojdn(end)):
+            year, whole = segment[2:]
+            bodies = None
+            if whole and cache:
+                version = data_version(year, stable)[0]
+                bodies = dict((v, get_fragment(year, v, version))
+                              for v in variants)
+                if None in bodies.values():
+                    bodies = None
+            if bodies is None:
+                run.append(segment)
+                continue
+            if run:
+                render(run)
+                run = []
+            for sink in sinks:
+                sink.write(bodies[sink.variant])
+        if run:
+            render(run)
+        complete = True
+    finally:
+        for sink in sinks:
+            sink.close(complete)
+
+
+def gen_cal(start, end, fp, executor=None, gz=False, keepplain=False,
+            stable=False):
     ''' generate lunar calendar in iCalendar format.
     Args:
         start and end date in ISO format, like 2010-12-31
-        fp: path to output file
+        fp: path to output file, or a file object
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+        gz, keepplain: write fp.gz, and fp as well, see IcalSink
+        stable: reproducible calendar, see generate and IcalSink
     Return:
         none
         '''
-    startyear = int(start[:4])
-    endyear = int(end[:4])
-    if startyear > 1900 and endyear < 2101:
-        # use Lunar Calendar from HKO
-        print('use Lunar Calendar from HKO')
-        sql = ('select date, lunardate, holiday, jieqi from ical '
-               'where date>=? and date<=? order by date')
-        rows = query_db(sql, (start, end))
-    else:
-        # compute Lunar Calendar by astronomical algorithm
-        print('compute Lunar Calendar by astronomical algorithm ')
-        rows = []
-        for year in range(startyear, endyear + 1):
-            row = cn_lunarcal(year)
-            rows.extend(row)
-
-    lines = [ICAL_HEAD]
-    oneday = timedelta(days=1)
-    for r in rows:
-        dt = datetime.strptime(r['date'], '%Y-%m-%d')
-
-        if r['lunardate'] in list(CN_MON.keys()):
-            ld = ['%s%s' % (lunaryear(r['date']), r['lunardate'])]
-        else:
-            ld = [r['lunardate']]
-        if r['holiday']:
-            ld.append(r['holiday'])
-        if r['jieqi']:
-            ld.append(r['jieqi'])
-        uid = '%s-lc@infinet.github.io' % r['date']
-        summary = ' '.join(ld)
-        utcstamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-        line = ICAL_SEC % (utcstamp, uid, dt.strftime('%Y%m%d'),
-                       (dt + oneday).strftime('%Y%m%d'), summary)
-        lines.append(line)
-    lines.append(ICAL_END)
-    outputf = open(fp, 'w')
-    outputf.write('\n'.join(lines))
-    outputf.close()
-    print('iCal lunar calendar from %s to %s saved to %s' % (start, end, fp))
-
-
-def gen_cal_jieqi_only(start, end, fp):
+    sink = IcalSink(fp, 'full', gz, keepplain, stable)
+    generate(start, end, [sink], executor, stable=stable)
+    if isinstance(fp, str):
+        print('iCal lunar calendar from %s to %s saved to %s' %
+              (start, end, ', '.join(sink.paths)), file=sys.stderr)
+
+
+def gen_cal_jieqi_only(start, end, fp, executor=None, gz=False,
+                       keepplain=False, stable=False):
     ''' generate Jieqi and Traditional Chinese in iCalendar format.
     Args:
         start and end date in ISO format, like 2010-12-31
-        fp: path to output file
+        fp: path to output file, or a file object
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+        gz, keepplain: write fp.gz, and fp as well, see IcalSink
+        stable: reproducible calendar, see generate and IcalSink
     Return:
         none
         '''
-    startyear = int(start[:4])
-    endyear = int(end[:4])
-    if startyear > 1900 and endyear < 2101:
-        # use Lunar Calendar from HKO
-        print('use Lunar Calendar from HKO')
-        sql = ('select date, lunardate, holiday, jieqi from ical '
-               'where date>=? and date<=? order by date')
-        rows = query_db(sql, (start, end))
-    else:
-        # compute Lunar Calendar by astronomical algorithm
-        print('compute Lunar Calendar by astronomical algorithm ')
-        rows = []
-        for year in range(startyear, endyear + 1):
-            row = cn_lunarcal(year)
-            rows.extend(row)
-
-    lines = [ICAL_HEAD]
-    oneday = timedelta(days=1)
-    for r in rows:
-        if not r['holiday'] and not r['jieqi']:
-            continue
+    sink = IcalSink(fp, 'jieqi', gz, keepplain, stable)
+    generate(start, end, [sink], executor, stable=stable)
+    if isinstance(fp, str):
+        print('iCal Jieqi/Traditional Chinese holiday calendar from %s to %s '
+              'saved to %s' % (start, end, ', '.join(sink.paths)),
+              file=sys.stderr)
+
+
+def read_manifest(path):
+    ''' read the calendars to build from a JSON file like
+
+        {"stable": true,
+         "artifacts": [
+            {"output": "chinese_lunar_{start}_{end}.ics",
+             "start": "2010-01-01", "end": "2019-12-31"},
+            {"output": "jieqi_tch_{year}.ics", "variant": "jieqi",
+             "start": "2020-01-01", "end": "2029-12-31", "per_year": true,
+             "gzip": true, "keep_plain": true}]}
+
+    start and end default to the previous and the next year, variant to full.
+    per_year makes one calendar for each Gregorian year from start to end. The
+    output is formatted with start, end, year and variant, a relative path is
+    relative to the manifest.
 
-        ld = []
-        if r['holiday']:
-            ld.append(r['holiday'])
-        if r['jieqi']:
-            ld.append(r['jieqi'])
-        uid = '%s-lc@infinet.github.io' % r['date']
-        summary = ' '.join(ld)
-        utcstamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-        dt = datetime.strptime(r['date'], '%Y-%m-%d')
-        line = ICAL_SEC % (utcstamp, uid, dt.strftime('%Y%m%d'),
-                       (dt + oneday).strftime('%Y%m%d'), summary)
-        lines.append(line)
-    lines.append(ICAL_END)
-    outputf = open(fp, 'w')
-    outputf.write('\n'.join(lines))
-    outputf.close()
-    print('iCal Jieqi/Traditional Chinese holiday calendar from %s to %s saved to %s' % (start, end, fp))
-
-
-def post_process():
+    Return:
+        (list of artifacts, stable), an artifact is a dict of output, start,
+        end, variant, gzip and keep_plain
+    '''
+    with open(path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'artifacts': manifest}
+
+    cy = datetime.today().year
+    basedir = os.path.dirname(os.path.abspath(path))
+    artifacts = []
+    for item in manifest.get('artifacts', []):
+        if 'output' not in item:
+            raise ValueError('artifact without output: %r' % item)
+        variant = item.get('variant', 'full')
+        if variant not in VARIANTS:
+            raise ValueError('unknown variant %s' % variant)
+        start = item.get('start', '%d-01-01' % (cy - 1))
+        end = item.get('end', '%d-12-31' % (cy + 1))
+        if isojdn(start) > isojdn(end):
+            raise ValueError('%s is after %s' % (start, end))
+        spans = [(start, end, None)]
+        if item.get('per_year'):
+            spans = [(jdniso(lo), jdniso(hi), year) for lo, hi, year, whole
+                     in year_segments(isojdn(start), isojdn(end))]
+        for start, end, year in spans:
+            try:
+                output = item['output'].format(start=start, end=end,
+                                               year=year, variant=variant)
+            except (KeyError, IndexError) as err:
+                raise ValueError('bad field %s in output %s' %
+                                 (err, item['output']))
+            artifacts.append({'output': os.path.join(basedir, output),
+                              'start': start,
+                              'end': end,
+                              'variant': variant,
+                              'gzip': bool(item.get('gzip')),
+                              'keep_plain': bool(item.get('keep_plain'))})
+    return artifacts, bool(manifest.get('stable'))
+
+
+def write_artifact(artifact, segments, bodies, stable=False):
+    ''' write a calendar of a manifest from the VEVENTs rendered
+    Args:
+        artifact: dict, see read_manifest
+        segments: list of keys in bodies, in order
+        bodies: dict of (first, last, variant): VEVENTs
+    Return:
+        list of files written
+    '''
+    sink = IcalSink(artifact['output'], artifact['variant'],
+                    artifact['gzip'], artifact['keep_plain'], stable)
+    complete = False
+    sink.open()
+    try:
+        for key in segments:
+            sink.write(bodies[key])
+        complete = True
+    finally:
+        sink.close(complete)
+    return sink.paths
+
+
+def build(path, executor=None):
+    ''' build every calendar listed in a manifest, see read_manifest.
+
+    The days the calendars cover are made once, each part of a year a
+    calendar has is rendered once, in executor if given, then the calendars
+    are written at the same time. Whole years rendered before are read from
+    db, see generate.
+
+    Args:
+        path: the manifest file
+        executor: optional concurrent.futures.Executor to search and render
+                  on
+    '''
+    artifacts, stable = read_manifest(path)
+    if not artifacts:
+        print('nothing to build in %s' % path, file=sys.stderr)
+        return
+
+    # the day ranges needed, overlapping and adjacent ones are merged
+    ranges = []
+    for first, last in sorted((isojdn(a['start']), isojdn(a['end']))
+                              for a in artifacts):
+        if ranges and first <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], last)
+        else:
+            ranges.append([first, last])
+    days = np.concatenate([fetch_days(jdniso(first), jdniso(last), executor)
+                           for first, last in ranges])
+
+    utcstamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    versions = {}
+    bodies = {}
+    jobs = []
+    layouts = []
+    for a in artifacts:
+        layout = []
+        for lo, hi, year, whole in year_segments(isojdn(a['start']),
+                                                 isojdn(a['end'])):
+            key = (lo, hi, a['variant'])
+            layout.append(key)
+            if key in bodies:
+                continue
+            if year not in versions:
+                versions[year] = data_version(year, stable)
+            version = versions[year][0]
+            bodies[key] = get_fragment(year, a['variant'], version) \
+                if whole else None
+            if bodies[key] is None:
+                jobs.append((key, year, whole))
+        layouts.append(layout)
+
+    if jobs:
+        first = np.searchsorted(days['jdn'], [key[0] for key, _, _ in jobs])
+        last = np.searchsorted(days['jdn'], [key[1] for key, _, _ in jobs],
+                               side='right')
+        args = ([days[i:j] for i, j in zip(first, last)],
+                [key[2] for key, _, _ in jobs],
+                [versions[year][1] or utcstamp for _, year, _ in jobs])
+        mapper = executor.map if executor else map
+        fragments = {}
+        for (key, year, whole), body in zip(jobs, mapper(render_days, *args)):
+            bodies[key] = body
+            if whole:
+                fragments.setdefault(year, {})[key[2]] = body
+        for year, rendered in fragments.items():
+            put_fragments(year, versions[year][0], rendered)
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = [pool.submit(write_artifact, a, layout, bodies, stable)
+                   for a, layout in zip(artifacts, layouts)]
+        for a, future in zip(artifacts, futures):
+            print('%s calendar from %s to %s saved to %s' %
+                  (a['variant'], a['start'], a['end'],
+                   ', '.join(future.result())), file=sys.stderr)
+
+
+def post_process(db, first=None, last=None):
     ''' there are several mistakes in HK OBS data, the following date
     do not have a valid lunar date, instead are the weekday names, they
-    are all 三十 '''
-    sql_update = 'update ical set lunardate=? where date=?'
+    are all 三十
+    Args:
+        db: sqlite3 connection, the caller commits
+        first, last: optional julian day numbers, only fix days between
+    '''
+    sql_update = 'update ical set lday=? where jdn=?'
 
     HK_ERROR = ('2036-01-27', '2053-12-09', '2056-03-15',
                 '2063-07-25', '2063-10-21', '2063-12-19')
-    conn = sqlite3.connect(DB_FILE)
-    db = conn.cursor()
-    for d in HK_ERROR:
-        print('fix lunar date for %s' % d)
-        db.execute(sql_update, ('三十', d))
-    conn.commit()
+    fixes = [d for d in HK_ERROR
+             if (first is None or isojdn(d) >= first) and
+             (last is None or isojdn(d) <= last)]
+    db.executemany(sql_update, [(30, isojdn(d)) for d in fixes])
+    if fixes:
+        print('fix lunar date for %s' % ', '.join(fixes), file=sys.stderr)
 
 
-def update_holiday():
-    ''' write chinese traditional holiday to db
+def update_holiday(db, first=None, last=None):
+    ''' write chinese traditional holiday to db, see
+    lunarcalbase.mark_holiday
 
     腊八节(腊月初八)     除夕(腊月的最后一天)     春节(一月一日)
     元宵节(一月十五日)   寒食节(清明的前一天)     端午节(五月初五)
     七夕节(七月初七)     中元节(七月十五日)       中秋节(八月十五日)
     重阳节(九月九日)     下元节(十月十五日)
 
+    Args:
+        db: sqlite3 connection, the caller commits
+        first, last: optional julian day numbers, only update days between
     '''
-    sql = 'select * from ical order by date'
-    rows = query_db(sql)
-    args = []
-    m = None
-    previd = None
-    for r in rows:
-        try:
-            d = CN_DAY[r['lunardate']]
-        except KeyError:
-            #print 'debug: %s %s' % (r['date'], r['lunardate'])
-            m = CN_MON[r['lunardate']]
-            d = 1
-
-        if not m:
-            continue
-
-        if m == 12 and d == 8:
-            args.append((r['id'], '腊八'))
-        elif m == 1 and d == 1:
-            args.append((r['id'], '春节'))
-            args.append((previd, '除夕'))
-        elif m == 1 and d == 15:
-            args.append((r['id'], '元宵'))
-        elif m == 5 and d == 5:
-            args.append((r['id'], '端午'))
-        elif m == 7 and d == 7:
-            args.append((r['id'], '七夕'))
-        elif m == 7 and d == 15:
-            args.append((r['id'], '中元'))
-        elif m == 8 and d == 15:
-            args.append((r['id'], '中秋'))
-        elif m == 9 and d == 9:
-            args.append((r['id'], '重阳'))
-        elif m == 10 and d == 15:
-            args.append((r['id'], '下元'))
-
-        if r['jieqi'] == '清明':
-            args.append((previd, '寒食'))
-        previd = r['id']
-
-    sql_update = 'update ical set holiday=? where id=?'
-    conn = sqlite3.connect(DB_FILE)
-    db = conn.cursor()
-    for arg in args:
-        db.execute(sql_update, (arg[1], arg[0]))
-        print('update %s' % arg[1])
-    conn.commit()
-    print('Chinese Traditional Holiday updated')
+    first = -2 ** 31 if first is None else first
+    last = 2 ** 31 - 2 if last is None else last
+    # one more day to find 除夕 and 寒食 of the last day
+    sql = ('select jdn, lmonth + 100 * leap, lday, term, 0 from ical '
+           'where source=? and jdn>=? and jdn<=? order by jdn')
+    rows = db.execute(sql, (SOURCE_HKO, first, last + 1)).fetchall()
+    days = np.array([tuple(r) for r in rows], dtype=DAY_DTYPE)
+    mark_holiday(days)
+
+    db.execute('update ical set hcode=0 where source=? and jdn>=? and jdn<=?',
+               (SOURCE_HKO, first, last))
+    marked = days[(days['holiday'] > 0) & (days['jdn'] <= last)]
+    db.executemany('update ical set hcode=? where jdn=?',
+                   marked[['holiday', 'jdn']].tolist())
+    print('%d Chinese Traditional Holidays updated' % len(marked),
+          file=sys.stderr)
 
 
 def ganzhi(lyear):
@@ -349,39 +1311,260 @@ def ganzhi(lyear):
     return '%s%s[%s]' % (g, z, sx)
 
 
-def lunaryear(isodate):
-    '''find lunar year for a date'''
-    sql = ('select date from ical where lunardate="正月" and '
-           'date<=? order by date desc limit 1')
-    row = query_db(sql, (isodate,), one=True)
-    res = 'Unknown'
-    if row:
-        res = ganzhi(row[0][:4])
+# (year, data version): (array of DAY_DTYPE, array of lunar years) of a whole
+# Gregorian year, see year_index
+YEAR_INDEX = LRUCache(YEAR_INDEX_BYTES, lambda x: x[0].nbytes + x[1].nbytes)
+
+
+def year_index(years, executor=None):
+    ''' days of whole Gregorian years and their lunar years. They are kept in
+    YEAR_INDEX until the data of the year changes, see data_version, the years
+    not there are made in runs of consecutive years.
+
+    Args:
+        years: list of Gregorian years in order
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+    Return:
+        dict of year: (array of DAY_DTYPE, array of lunar years)
+    '''
+    index = {}
+    runs = []
+    for year in years:
+        key = (year, data_version(year)[0])
+        res = YEAR_INDEX.get(key)
+        if res is not None:
+            index[year] = res
+        elif runs and year == runs[-1][-1][0] + 1:
+            runs[-1].append(key)
+        else:
+            runs.append([key])
+
+    for run in runs:
+        days = fetch_days('%d-01-01' % run[0][0], '%d-12-31' % run[-1][0],
+                          executor)
+        lyears = mark_lunaryear(days)
+        bounds = np.searchsorted(days['jdn'], [isojdn('%d-01-01' % key[0])
+                                               for key in run[1:]])
+        for key, d, y in zip(run, np.split(days, bounds),
+                             np.split(lyears, bounds)):
+            # copies, a view would keep the days of the whole run alive
+            index[key[0]] = (d.copy(), y.copy())
+            YEAR_INDEX.put(key, index[key[0]])
+    return index
+
+
+def convert_dates(dates, executor=None):
+    ''' convert Gregorian dates to lunar dates in one pass, the dates of the
+    same year are looked up together in the days of the year, see year_index
+
+    Args:
+        dates: list of dates in ISO format, like 2031-07-14
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+    Return:
+        list of dictionaries in the order of dates, with date in ISO format,
+        lyear, ganzhi of lyear, month from 1 to 12, leap, day, and lunardate,
+        jieqi, holiday in Chinese
+    Raise:
+        ValueError if a date is not in ISO format
+    '''
+    jdns = np.array([isojdn(x) for x in dates], dtype=int)
+    ymds = [jdnymd(x) for x in jdns.tolist()]
+    years = np.array([x[0] for x in ymds], dtype=int)
+    index = year_index(sorted(set(years.tolist())), executor)
+
+    res = [None] * len(dates)
+    yearnames = {}
+    for year, (days, lyears) in index.items():
+        pos = np.nonzero(years == year)[0]
+        offset = jdns[pos] - days['jdn'][0]
+        for i, (jdn, month, day, jieqi, holiday), lyear in zip(
+                pos.tolist(), days[offset].tolist(), lyears[offset].tolist()):
+            if lyear not in yearnames:
+                yearnames[lyear] = ganzhi(lyear)
+            res[i] = lunardate_dict('%04d-%02d-%02d' % ymds[i], lyear,
+                                    yearnames[lyear], month, day, jieqi,
+                                    holiday)
     return res
 
 
+def lunardate_dict(isodate, lyear, yearname, month, day, jieqi, holiday):
+    ''' a lunar date as answered by convert_dates and lunar_date '''
+    return {'date': isodate,
+            'lyear': lyear,
+            'ganzhi': yearname,
+            'month': month % 100,
+            'leap': month > 100,
+            'day': day,
+            'lunardate': MONTH_NAME[month] + ('初一' if day == 1
+                                              else DAY_NAME[day]),
+            'jieqi': SOLARTERM_NAMES[jieqi],
+            'holiday': HOLIDAYS[holiday]}
+
+
+class MonthIndex(object):
+    ''' lunar month starts of Gregorian years, in a sorted list of julian day
+    numbers along with the month and the lunar year of each, a day of those
+    years is converted by one bisect. Solar terms and holidays are kept by
+    julian day number.
+
+    The index is replaced as a whole when years are loaded, a lookup sees
+    either the old or the new one.
+
+    Attributes:
+        years: frozenset of Gregorian years in the index
+    '''
+
+    EMPTY = (frozenset(), [], [], {}, {})
+
+    def __init__(self):
+        # (years, sorted jdn of month starts, list of (month, lunar year),
+        #  jdn: jieqi, jdn: holiday)
+        self._state = self.EMPTY
+        self._lock = threading.Lock()
+
+    @property
+    def years(self):
+        return self._state[0]
+
+    def load(self, years, executor=None):
+        ''' add Gregorian years not in the index yet, see year_index '''
+        with self._lock:
+            loaded, starts, months, terms, holidays = self._state
+            years = sorted(set(years) - loaded)
+            if not years:
+                return
+            monthstarts = dict(zip(starts, months))
+            terms, holidays = dict(terms), dict(holidays)
+            for year, (days, lyears) in year_index(years, executor).items():
+                if not len(days):
+                    continue
+                # the month the year begins in starts in the year before
+                first = days[0]
+                monthstarts[int(first['jdn'] - first['day']) + 1] = (
+                    int(first['month']), int(lyears[0]))
+                new = days['day'] == 1
+                monthstarts.update(
+                    (jdn, (month, lyear)) for jdn, month, lyear in zip(
+                        days['jdn'][new].tolist(),
+                        days['month'][new].tolist(), lyears[new].tolist()))
+                for field, marks in (('jieqi', terms),
+                                     ('holiday', holidays)):
+                    mask = days[field] > 0
+                    marks.update(zip(days['jdn'][mask].tolist(),
+                                     days[field][mask].tolist()))
+            starts = sorted(monthstarts)
+            self._state = (loaded | frozenset(years), starts,
+                           [monthstarts[x] for x in starts], terms, holidays)
+
+    def clear(self):
+        ''' forget every year, e.g. after the data is changed '''
+        with self._lock:
+            self._state = self.EMPTY
+
+    def lookup(self, jdn, year):
+        ''' lunar date of a day
+        Args:
+            jdn: julian day number of the day
+            year: Gregorian year of the day
+        Return:
+            (lunar year, month, day, jieqi, holiday), month is 101 to 112 in
+            a leap month, jieqi and holiday index SOLARTERM_NAMES and HOLIDAYS.
+            None if the year is not loaded.
+        '''
+        years, starts, months, terms, holidays = self._state
+        if year not in years:
+            return None
+        i = bisect_right(starts, jdn) - 1
+        month, lyear = months[i]
+        return (lyear, month, jdn - starts[i] + 1, terms.get(jdn, 0),
+                holidays.get(jdn, 0))
+
+
+MONTH_INDEX = MonthIndex()
+
+
+def lunar_date(isodate, executor=None):
+    ''' convert a Gregorian date to lunar date. The first date of a year
+    loads the lunar months of the year into MONTH_INDEX, a date of a year
+    loaded is converted by a bisect. Load many years ahead by, e.g.
+
+        MONTH_INDEX.load(range(1901, 2101))
+
+    Args:
+        isodate: date in ISO format, like 2031-07-14
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+    Return:
+        dictionary, see convert_dates
+    Raise:
+        ValueError if the date is not in ISO format
+    '''
+    jdn = isojdn(isodate)
+    ymd = jdnymd(jdn)
+    res = MONTH_INDEX.lookup(jdn, ymd[0])
+    # again if the index is cleared meanwhile
+    while res is None:
+        MONTH_INDEX.load([ymd[0]], executor)
+        res = MONTH_INDEX.lookup(jdn, ymd[0])
+    lyear, month, day, jieqi, holiday = res
+    return lunardate_dict('%04d-%02d-%02d' % ymd, lyear, ganzhi(lyear),
+                          month, day, jieqi, holiday)
+
+
 def main():
     cy = datetime.today().year
     start = '%d-01-01' % (cy - 1)
     end = '%d-12-31' % (cy + 1)
 
-    helpmsg = ('Usage: lunar_ical.py --start=startdate --end=enddate --jieqi\n'
+    helpmsg = ('Usage: lunar_ical.py --start=startdate --end=enddate --jieqi '
+'--both --workers=N --mirror=path --refresh --gzip --keep-plain --stable '
+'--manifest=file --serve=[host:]port\n'
 'Example: \n'
 '\tlunar_ical.py --start=2013-10-31 --end=2015-12-31\n'
 'Or to generate Jieqi only:\n'
 '\tlunar_ical.py --start=2013-10-31 --end=2015-12-31 --jieqi\n'
+'Or to generate both the full and the Jieqi only calendar in one pass:\n'
+'\tlunar_ical.py --start=2013-10-31 --end=2015-12-31 --both\n'
+'Or to search solar terms and newmoons of a computed year in 4 processes:\n'
+'\tlunar_ical.py --start=2101-01-01 --end=2101-12-31 --workers=4\n'
+'Or to build the db from a directory or tarball of the HKO files:\n'
+'\tlunar_ical.py --mirror=hko.tar.gz\n'
+'Or to fetch again the HKO files changed since last time:\n'
+'\tlunar_ical.py --refresh\n'
+'Or to write the calendar compressed, and uncompressed as well:\n'
+'\tlunar_ical.py --start=1901-01-01 --end=2100-12-31 --gzip --keep-plain\n'
+'Or to make the same file from the same data, with a .sha256 file aside:\n'
+'\tlunar_ical.py --stable\n'
+'Or to build all the calendars listed in a JSON manifest in 4 processes:\n'
+'\tlunar_ical.py --manifest=build.json --workers=4\n'
+'Or to serve calendars on http://127.0.0.1:8080/ics?start=...&end=...:\n'
+'\tlunar_ical.py --serve=8080\n'
 'Or,\n'
 '\tlunar_ical.py without option will generate the calendar from previous year '
 'to the end of the next year')
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], 'h',
-                                   ['start=', 'end=', 'help', 'jieqi'])
+                                   ['start=', 'end=', 'help', 'jieqi', 'both',
+                                    'workers=', 'mirror=', 'refresh', 'gzip',
+                                    'keep-plain', 'stable', 'manifest=',
+                                    'serve='])
     except getopt.GetoptError as err:
         print(str(err))
         print(helpmsg)
         sys.exit(2)
     jieqionly = False
+    both = False
+    executor = None
+    mirror = None
+    refresh = False
+    gz = False
+    keepplain = False
+    stable = False
+    manifest = None
+    serve = None
     for o, v in opts:
         if o == '--start':
             start = v
@@ -389,61 +1572,88 @@ def main():
             end = v
         elif o == '--jieqi':
             jieqionly = True
+        elif o == '--both':
+            both = True
+        elif o == '--workers':
+            executor = ProcessPoolExecutor(max_workers=int(v))
+        elif o == '--mirror':
+            mirror = v
+        elif o == '--refresh':
+            refresh = True
+        elif o == '--gzip':
+            gz = True
+        elif o == '--keep-plain':
+            keepplain = True
+        elif o == '--stable':
+            stable = True
+        elif o == '--manifest':
+            manifest = v
+        elif o == '--serve':
+            host, _, port = v.rpartition(':')
+            serve = (host or '127.0.0.1', int(port))
         elif 'h' in o:
             sys.exit(helpmsg)
 
-    if not os.path.exists(DB_FILE):
-        initdb()
-        update_cal()
-        post_process()  # fix error in HK data
-        update_holiday()
+    try:
+        if isojdn(start) > isojdn(end):
+            sys.exit('%s is after %s' % (start, end))
+    except ValueError as err:
+        sys.exit(str(err))
+
+    newdb = not os.path.exists(DB_FILE)
+    initdb()  # also upgrades db made by older version
+    if newdb:
+        update_cal(mirror)
+    elif refresh:
+        refresh_cal(mirror)
     if len(sys.argv) == 1:
-        fp = OUTPUT % ('prev_year', 'next_year')
+        names = ('prev_year', 'next_year')
     else:
-        fp = OUTPUT % (start, end)
-
-    if jieqionly:
-        if len(sys.argv) == 1:
-            fp = OUTPUT_JIEQI % ('prev_year', 'next_year')
-        else:
-            fp = OUTPUT_JIEQI % (start, end)
+        names = (start, end)
 
-        gen_cal_jieqi_only(start, end, fp)
+    if serve:
+        # imported here, lunarserver imports this module
+        import lunarserver
+        lunarserver.serve(serve[0], serve[1], executor)
+    elif manifest:
+        try:
+            build(manifest, executor)
+        except (OSError, ValueError) as err:
+            sys.exit('can not build %s: %s' % (manifest, err))
+    elif both:
+        sinks = [IcalSink(OUTPUT % names, 'full', gz, keepplain, stable),
+                 IcalSink(OUTPUT_JIEQI % names, 'jieqi', gz, keepplain,
+                          stable)]
+        generate(start, end, sinks, executor, stable=stable)
+        for sink in sinks:
+            print('iCal calendar from %s to %s saved to %s' %
+                  (start, end, ', '.join(sink.paths)), file=sys.stderr)
+    elif jieqionly:
+        gen_cal_jieqi_only(start, end, OUTPUT_JIEQI % names, executor, gz,
+                           keepplain, stable)
     else:
-        if len(sys.argv) == 1:
-            fp = OUTPUT % ('prev_year', 'next_year')
-        else:
-            fp = OUTPUT % (start, end)
+        gen_cal(start, end, OUTPUT % names, executor, gz, keepplain, stable)
 
-        gen_cal(start, end, fp)
+    if executor:
+        executor.shutdown()
 
 
 def verify_lunarcalendar():
     ''' verify lunar calendar against data from HKO'''
     start = 1949
-    sql = 'select date, lunardate,jieqi from ical where date>=? and date<=?'
     while start < 2101:
         print('compare %d' % start)
-        ystart = '%d-01-01' % start
-        yend = '%d-12-31' % start
-        res = query_db(sql, (ystart, yend))
-        hko = []
-        for x in res:
-            if x[2]:
-                hko.append((x[0], '%s %s' % (x[1], x[2])))
-            else:
-                hko.append((x[0], x[1]))
-
-        aalc = cn_lunarcal(start)
-        for i in range(len(aalc)):
-            aaday, aaldate = aalc[i]['date'], aalc[i]['lunardate']
-            if aalc[i]['jieqi']:
-                aaldate = '%s %s' % (aalc[i]['lunardate'], aalc[i]['jieqi'])
-            hkoday, hkoldate = hko[i]
-            #print aaday, aaldate
-            if aaday != hkoday or aaldate != hkoldate:
-                print('AA %s %s, HKO %s %s' % (aaday, aaldate, hkoday,
-                                               hkoldate))
+        ystart = isojdn('%d-01-01' % start)
+        yend = isojdn('%d-12-31' % start)
+        hko = list(lunarcal_rows(query_days(ystart, yend, SOURCE_HKO)))
+
+        aalc = list(lunarcal_rows(cn_lunarcal(start)))
+        for aa, hk in zip(aalc, hko):
+            aaldate = ' '.join(x for x in (aa['lunardate'], aa['jieqi']) if x)
+            hkoldate = ' '.join(x for x in (hk['lunardate'], hk['jieqi']) if x)
+            if aa['date'] != hk['date'] or aaldate != hkoldate:
+                print('AA %s %s, HKO %s %s' % (aa['date'], aaldate,
+                                               hk['date'], hkoldate))
         start += 1
 
 
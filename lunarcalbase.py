@@ -8,12 +8,25 @@ __license__ = 'BSD'
 __copyright__ = '2020, Chen Wei <weichen302@gmail.com>'
 __version__ = '0.0.3'
 
-from aa_full import findnewmoons
-from aa_full import solarterm
+from collections import OrderedDict
+from functools import lru_cache
+import math
+import sys
+import threading
+
+import numpy as np
+from astrostore import lunation
+from astrostore import lunationnewmoon
+from astrostore import MEAN_SYNODIC_MONTH
+from astrostore import NM_EPOCH
+from astrostore import solarterm
+from astrostore import termsolarterm
+from aa import g2jd
+from aa import jd2g
 from aa import jdptime
 from aa import jdftime
 
-__all__ = ['cn_lunarcal']
+__all__ = ['cn_lunarcal', 'lunarcal_range', 'lunarcal_rows']
 
 LCSTARTMONTH = 11
 
@@ -28,11 +41,10 @@ CN_MON = {1: '正月',  2: '二月',  3: '三月',    4: '四月',
           5: '五月',  6: '六月',  7: '七月',    8: '八月',
           9: '九月', 10: '十月', 11: '十一月', 12: '十二月',
 
-         99: '閏十一月', 100: '閏十二月', 101: '閏正月',
-        102: '閏二月',   103: '閏三月',   104: '閏四月',
-        105: '閏五月',   106: '閏六月',   107: '閏七月',
-        108: '閏八月',   109: '閏九月',   110: '閏十月',
-        111: '閏十一月', 112: '閏十二月'}
+        101: '閏正月',   102: '閏二月',   103: '閏三月',
+        104: '閏四月',   105: '閏五月',   106: '閏六月',
+        107: '閏七月',   108: '閏八月',   109: '閏九月',
+        110: '閏十月',   111: '閏十一月', 112: '閏十二月'}
 
 CN_SOLARTERM = {-120: '小雪',-105: '大雪',
                  -90: '冬至', -75: '小寒', -60: '大寒',
@@ -55,16 +67,95 @@ CN_SOLARTERM = {-120: '小雪',-105: '大雪',
                  225: '立冬', 240: '小雪', 255: '大雪', 270: '冬至'}
 
 
+# days are kept in numpy structured array, one record per day:
+#   jdn: Julian Day Number
+#   month: month number as in CN_MON
+#   day: day of month
+#   jieqi: index to SOLARTERM_NAMES, 0 for none, (angle / 15) % 24 + 1
+#   holiday: index to HOLIDAYS, 0 for none
+DAY_DTYPE = np.dtype([('jdn', 'i4'), ('month', 'i1'), ('day', 'i1'),
+                      ('jieqi', 'i1'), ('holiday', 'i1')])
+
+SOLARTERM_NAMES = (None,) + tuple(CN_SOLARTERM[a if a <= 270 else a - 360]
+                                  for a in range(0, 360, 15))
+
+HOLIDAYS = (None, '腊八', '除夕', '春节', '元宵', '寒食', '端午', '七夕',
+            '中元', '中秋', '重阳', '下元')
+HOLIDAY_CODE = dict((x, i) for i, x in enumerate(HOLIDAYS))
+
+
+class LRUCache(object):
+    ''' a thread-safe least recently used cache, bounded by the approximate
+    size of its values in bytes rather than the number of entries.
+
+    Values are shared by every caller, they must not be modified once put.
+
+    '''
+
+    def __init__(self, maxbytes, sizeof=sys.getsizeof):
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key: (value, size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._data.pop(key)[1]
+            if size > self.maxbytes:
+                return
+            self._data[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.maxbytes:
+                self.nbytes -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        ''' a dictionary of hits, misses, entries and bytes '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._data), 'bytes': self.nbytes,
+                    'maxbytes': self.maxbytes}
+
+
 # calendar for this and next year are combined to generate the final output
 # cache the intermedia calendar
-CALCACHE = {'cached': []}
-MAXCACHE = 500  # max cached items
+MAXCACHE_BYTES = 64 * 1024 * 1024
+CALCACHE = LRUCache(MAXCACHE_BYTES, lambda days: days.nbytes)
 
 
-def find_astro(year):
+def find_astro(year, executor=None):
     ''' find new moons and solar terms needed for calculate lunar calendar
     Arg:
         year is a integer
+        executor: optional concurrent.futures.Executor, if given the solar
+                  terms and newmoons are searched concurrently on it
     Return:
         list of dictionaries
             [ {date,
@@ -74,31 +165,43 @@ def find_astro(year):
         '''
     # find all solar terms from -120 to +270 degree, negative angle means
     # search backward from Vernal Equinox
-    solarterms = []
-    angle = -120
-
-    while angle <= 270:
-        jdst = solarterm(year, angle)
-        solarterms.append([jdst, angle])
-        #print angle, jdftime(jdst, tz=8, ut=True)
-        angle += 15
+    angles = range(-120, 271, 15)
+
+    if executor is None:
+        solarterms = []
+        for angle in angles:
+            jdst = solarterm(year, angle)
+            solarterms.append([jdst, angle])
+            #print angle, jdftime(jdst, tz=8, ut=True)
+
+        # search 16 newmoons start 30 days before last Winter Solstice
+        k = lunation(solarterms[1][0] - 30, margin=0)
+        nms = [lunationnewmoon(k + i) for i in range(16)]
+    else:
+        futures = [executor.submit(solarterm, year, angle) for angle in angles]
+        # every lunation is searched on its own once the first is known
+        k = lunation(futures[1].result() - 30, margin=0)
+        nms = list(executor.map(lunationnewmoon, range(k, k + 16)))
+        solarterms = [[f.result(), angle] for f, angle in zip(futures, angles)]
 
-    # search 15 newmoons start 30 days before last Winter Solstice
-    nms = findnewmoons(solarterms[1][0] - 30)
     aadays = [[x, 'newmoon'] for x in nms]
     aadays.extend(solarterms)
-    aadays.sort()
 
-    # normalize all Julian Day to midnight for later compare
+    # normalize all Julian Day to midnight for later compare, a newmoon goes
+    # before solar term of the same day as it starts the month of that day
     tmp = [(jdptime(jdftime(d[0], '%y-%m-%d', tz=8, ut=True), '%y-%m-%d'),
-               d[1]) for d in aadays]
-    astro = [{'date': d[0], 'astro': d[1], 'month': None} for d in tmp]
+               d[1] != 'newmoon', d[1]) for d in aadays]
+    tmp.sort(key=lambda x: x[:2])
+    astro = [{'date': d[0], 'astro': d[2], 'month': None} for d in tmp]
     return astro
 
 
 def mark_lunarcal_month(clc):
     ''' scan and modify the Chinese Lunar Calendar Astro list for start/end of
-    Chinese Lunar year and leapmonth'''
+    Chinese Lunar year and leapmonth
+
+    Every pass over the sorted astro list is linear.
+    '''
 
     # scan last and this Winter Solstice
     for d in clc:
@@ -115,25 +218,21 @@ def mark_lunarcal_month(clc):
         elif d['date'] > lastws:
             break
 
-    # mark month name, 11 is the month contains Winter Solstice
-    newmoondate = [d['date'] for d in clc if d['astro'] == 'newmoon']
-    mname = 11
-    for i in range(len(newmoondate) - 1):
-        thisnm, nextnm = newmoondate[i], newmoondate[i + 1]
-        if thisnm < lcstart:
+    # trim to days between two Winter Solstice, mark month name, 11 is the
+    # month contains Winter Solstice, every newmoon starts the next month
+    trimmed = []
+    mname = LCSTARTMONTH - 1
+    for d in clc:
+        if d['date'] < lcstart:
             continue
+        elif d['date'] > lcend:
+            break
+        if d['astro'] == 'newmoon':
+            mname += 1
+        d['month'] = mname
+        trimmed.append(d)
 
-        for d in clc:
-            if thisnm <= d['date'] and d['date'] < nextnm:
-                d['month'] = mname
-            elif d['date'] >= nextnm:
-                break
-        mname += 1
-
-    # trim to days between two Winter Solstice
-    clc = [d for d in clc if d['date'] >= lcstart and d['date'] <= lcend]
-
-    return scan_leap(clc)
+    return scan_leap(trimmed)
 
 
 def scan_leap(clc):
@@ -145,82 +244,76 @@ def scan_leap(clc):
 
         '''
     lcstart, lcend = clc[0]['date'], clc[-1]['date']
-    # scan for leap month
+    # scan for leap month, and months have a major solar term(中气)
     nmcount = 0
+    majorterm = set()
     for d in clc:
-        if (d['date'] > lcstart and d['date'] <= lcend and
-                                    d['astro'] == 'newmoon'):
-            nmcount += 1
-
-    # leap year has more than 12 newmoons between two Winter Solstice
+        if d['astro'] == 'newmoon':
+            if d['date'] > lcstart and d['date'] <= lcend:
+                nmcount += 1
+        elif d['astro'] % 30 == 0:
+            majorterm.add(d['month'])
+
+    # leap year has more than 12 newmoons between two Winter Solstice, the
+    # first month without major solar term is the leap month. Search from LC
+    # 11 to next LC 11, which = 11 + 13
+    monthofleap = None
     if nmcount > 12:
-        # search leap month from LC 11, to next LC 11, which = 11 + 13
         for m in range(11, 25):
-            foundleap = True
-            for d in clc:
-                if d['astro'] == 'newmoon':
-                    continue
-                if d['month'] == m and d['astro'] % 30 == 0:
-                    foundleap = False
-            if foundleap:
+            if m not in majorterm:
                 monthofleap = m
                 break
 
-        for d in clc:
-            if d['month'] == monthofleap:
-                d['month'] += -1 + 100  # add 100 to distinguish leap month
-            elif d['month'] > monthofleap:
-                d['month'] -= 1
-
     for d in clc:
+        leap = d['month'] == monthofleap
+        if monthofleap and d['month'] >= monthofleap:
+            d['month'] -= 1
+
         if d['month'] > 12:
             d['month'] -= 12
+        if leap:
+            d['month'] += 100  # add 100 to distinguish leap month
 
     return clc
 
 
 def mark_lunarcal_day(clcmonth):
-    ''' expand to whole year, mark the day of month and lunar calendar date in
-    Chinese'''
-
-    stdays= {}  # days have solar terms
-    for d in clcmonth:
-        if d['astro'] != 'newmoon':
-            stdays[d['date']] = d['astro']
-
-
-    # expand to whole year
-    start = clcmonth[0]['date']
-    yearend = clcmonth[-1]['date'] + 1
-    lcdays = []
-    while start < yearend:
-        # scan the month start belongs
-        for d in clcmonth:
-            if d['date'] > start:
-                break
-            if d['astro'] == 'newmoon':
-                monthstart = d['date']
-                mname = d['month']
+    ''' expand to whole year, mark the day of month and solar terms
 
-        day = {'date': start, 'month': mname, 'jieqi': None, 'holiday': None}
-        day['day'] = int(start + 1 - monthstart)
+    The days are laid out month by month from the newmoons in one pass,
+    clcmonth starts with the newmoon of LC 11.
 
-        if start in stdays:
-            day['jieqi'] = CN_SOLARTERM[stdays[start]]
+    Return:
+        numpy array of DAY_DTYPE
+    '''
 
-        if day['day'] == 1:
-            day['lunardate'] = CN_MON[day['month']]
+    nmjdn, nmmonth, stjdn, stcode = [], [], [], []
+    for d in clcmonth:
+        if d['astro'] == 'newmoon':
+            nmjdn.append(int(d['date'] + 0.5))
+            nmmonth.append(d['month'])
         else:
-            day['lunardate'] = CN_DAY[day['day']]
+            stjdn.append(int(d['date'] + 0.5))
+            stcode.append(d['astro'] // 15 % 24 + 1)
 
-        lcdays.append(day)
-        start += 1
+    # expand to whole year
+    start = nmjdn[0]
+    yearend = int(clcmonth[-1]['date'] + 0.5) + 1
+    monthstart = np.array(nmjdn) - start
+    monthlen = np.diff(np.append(monthstart, yearend - start))
+
+    lcdays = np.zeros(yearend - start, dtype=DAY_DTYPE)
+    lcdays['jdn'] = np.arange(start, yearend)
+    lcdays['month'] = np.repeat(nmmonth, monthlen)
+    lcdays['day'] = (np.arange(yearend - start)
+                     - np.repeat(monthstart, monthlen) + 1)
+    lcdays['jieqi'][np.array(stjdn) - start] = stcode
 
     return lcdays
 
 
 def mark_holiday(clcdays):
-    ''' mark Chinese Traditional Holiday
+    ''' mark Chinese Traditional Holiday on array of DAY_DTYPE in place
 
     腊八节(腊月初八)     除夕(腊月的最后一天)     春节(一月一日)
     元宵节(一月十五日)   寒食节(清明的前一天)     端午节(五月初五)
@@ -229,67 +322,95 @@ def mark_holiday(clcdays):
 
     '''
 
-    for i in range(len(clcdays)):
-        m, d = clcdays[i]['month'], clcdays[i]['day']
-        if m == 12 and d == 8:
-            clcdays[i]['holiday'] = '腊八'
-        elif m == 1 and d == 1:
-            clcdays[i]['holiday'] = '春节'
-            clcdays[i - 1]['holiday'] = '除夕'
-        elif m == 1 and d == 15:
-            clcdays[i]['holiday'] = '元宵'
-        elif m == 5 and d == 5:
-            clcdays[i]['holiday'] = '端午'
-        elif m == 7 and d == 7:
-            clcdays[i]['holiday'] = '七夕'
-        elif m == 7 and d == 15:
-            clcdays[i]['holiday'] = '中元'
-        elif m == 8 and d == 15:
-            clcdays[i]['holiday'] = '中秋'
-        elif m == 9 and d == 9:
-            clcdays[i]['holiday'] = '重阳'
-        elif m == 10 and d == 15:
-            clcdays[i]['holiday'] = '下元'
-
-        if clcdays[i]['jieqi'] == '清明':
-            clcdays[i - 1]['holiday'] = '寒食'
+    m, d = clcdays['month'], clcdays['day']
+    holiday = clcdays['holiday']
+    for hm, hd, name in ((12, 8, '腊八'), (1, 1, '春节'), (1, 15, '元宵'),
+                         (5, 5, '端午'), (7, 7, '七夕'), (7, 15, '中元'),
+                         (8, 15, '中秋'), (9, 9, '重阳'), (10, 15, '下元')):
+        holiday[(m == hm) & (d == hd)] = HOLIDAY_CODE[name]
+
+    # 除夕 is the day before 春节, 寒食 the day before 清明
+    for field, code, name in (('holiday', HOLIDAY_CODE['春节'], '除夕'),
+                              ('jieqi', SOLARTERM_NAMES.index('清明'), '寒食')):
+        prev = np.flatnonzero(clcdays[field] == code) - 1
+        holiday[prev[prev >= 0]] = HOLIDAY_CODE[name]
 
     return clcdays
 
 
-def search_lunarcal(year):
+def search_lunarcal(year, executor=None):
     ''' search JieQi and Newmoon, step 1
 
     Arg:
         year: integer like 2014
+        executor: optional concurrent.futures.Executor for find_astro
     Return:
-        a dictionary {ISODATE: Lunar Calendar Date in Chinese}
-        start at last LC November
+        a read-only array of DAY_DTYPE, start at last LC November. It is
+        shared through CALCACHE.
     '''
 
-    global CALCACHE
-    if year in CALCACHE:
-        return CALCACHE[year]
+    output = CALCACHE.get(year)
+    if output is not None:
+        return output
 
-    clc = find_astro(year)
+    clc = find_astro(year, executor)
     clcmonth = mark_lunarcal_month(clc)
     clcdays = mark_lunarcal_day(clcmonth)
-    clcdays = mark_holiday(clcdays)
+    output = mark_holiday(clcdays)
+    output.flags.writeable = False
 
-    output = {}
-    for d in clcdays:
-        output[d['date']] = d
-
-    CALCACHE[year] = output  # cache it for future use
-    CALCACHE['cached'].append(year)
-    if len(CALCACHE['cached']) > MAXCACHE:
-        del CALCACHE[CALCACHE['cached'][0]]
-        CALCACHE['cached'].pop(0)
+    CALCACHE.put(year, output)  # cache it for future use
 
     return output
 
 
-def cn_lunarcal(year):
+def localjdn(jd):
+    ''' Julian Day Number of the date in China(UTC+8) of an event in JDTT '''
+    return int(jdptime(jdftime(jd, '%y-%m-%d', tz=8, ut=True), '%y-%m-%d')
+               + 0.5)
+
+
+def lookahead(year, cal0, end):
+    ''' extend calendar of a year from search_lunarcal, which stops at the
+    Winter Solstice, to end.
+
+    Only the month containing the Winter Solstice and the month after it can
+    reach the end of Gregorian year. The latter is LC 12, unless it has no
+    major solar term 大寒, then it may be the leap 11 of a leap year, like the
+    one in 2033, and the whole next year is needed to tell.
+
+    Args:
+        year: integer like 2014
+        cal0: array of DAY_DTYPE from search_lunarcal(year)
+        end: Julian Day Number, no later than the next 小寒
+    Return:
+        array of DAY_DTYPE for the days after cal0 to end, or None if it can
+        not be settled without calendar of next year
+    '''
+    ws = cal0[-1]
+    m11start = int(ws['jdn'] - ws['day'] + 1)
+    k = lunation(m11start - 0.5, margin=0)
+    if localjdn(lunationnewmoon(k)) != m11start:
+        return None
+
+    tail = np.zeros(max(end - ws['jdn'], 0), dtype=DAY_DTYPE)
+    tail['jdn'] = np.arange(ws['jdn'] + 1, end + 1)
+    tail['month'] = 11
+    tail['day'] = tail['jdn'] - m11start + 1
+
+    nextnm = localjdn(lunationnewmoon(k + 1))
+    if nextnm <= end:
+        dahan = localjdn(solarterm(year + 1, -60))
+        if dahan >= localjdn(lunationnewmoon(k + 2)):
+            return None
+        lc12 = tail['jdn'] >= nextnm
+        tail['month'][lc12] = 12
+        tail['day'][lc12] = tail['jdn'][lc12] - nextnm + 1
+
+    return mark_holiday(tail)
+
+
+def cn_lunarcal(year, executor=None):
     ''' to generate lunar calendar for year, the search should started from
     previous Winter Solstice to next year's Winter Solstic.
 
@@ -298,29 +419,175 @@ def cn_lunarcal(year):
     leap 11 that belongs to the next year. Calendar for this and next year are
     computed and combined, then trim to fit into scale of this year.
 
+    The days after this Winter Solstice are usually settled by the lookahead
+    from a couple of newmoons and solar terms, the calendar of next year is
+    computed only when the lookahead can not tell.
+
+    The astronomical searches are spread across executor, a
+    concurrent.futures.Executor, when given.
+
+    Return:
+        a new array of DAY_DTYPE from Jan 1 to Dec 31, see lunarcal_rows
+
     '''
 
-    cal0 = search_lunarcal(year)
-    cal1 = search_lunarcal(year + 1)
-    for k, v in cal1.items():
-        cal0[k] = v
+    start = int(jdptime('%s-%s-%s' % (year, 1, 1), '%y-%m-%d') + 0.5)
+    end = int(jdptime('%s-%s-%s' % (year, 12, 31), '%y-%m-%d') + 0.5)
+
+    cal0 = search_lunarcal(year, executor)
+    # 小寒 is about 15 days after Winter Solstice, but guard it anyway
+    tail = None
+    if localjdn(solarterm(year + 1, -75)) > end:
+        tail = lookahead(year, cal0, end)
+
+    if tail is None:
+        cal1 = search_lunarcal(year + 1, executor)
+        cal = np.concatenate((cal0[cal0['jdn'] < cal1['jdn'][0]], cal1))
+    else:
+        cal = np.concatenate((cal0, tail))
+
+    jdn = cal['jdn']
+    return cal[(jdn >= start) & (jdn <= end)]
+
+
+@lru_cache(maxsize=4096)
+def newmoonjdn(k):
+    ''' Julian Day Number of the day of newmoon of lunation k '''
+    return localjdn(lunationnewmoon(k))
+
+
+@lru_cache(maxsize=4096)
+def termjdn(n):
+    ''' Julian Day Number of the day of solar term n, numbered as in
+    astrostore '''
+    return localjdn(termsolarterm(n))
+
+
+def lunation_of(jdn):
+    ''' lunation number of the month the day jdn is in '''
+    # the true newmoon is within a day of the mean newmoon, allow another two
+    # days for the time zone, delta T and rounding to day, most days are
+    # settled without search
+    x = (jdn - NM_EPOCH) / MEAN_SYNODIC_MONTH
+    k = int(math.floor(x))
+    margin = 3.0 / MEAN_SYNODIC_MONTH
+    if margin < x - k < 1 - margin:
+        return k
+
+    k = lunation(jdn - 0.5, margin=0)
+    while newmoonjdn(k) > jdn:
+        k -= 1
+    while newmoonjdn(k + 1) <= jdn:
+        k += 1
+    return k
 
-    start = jdptime('%s-%s-%s' % (year, 1, 1), '%y-%m-%d')
-    end = jdptime('%s-%s-%s' % (year, 12, 31), '%y-%m-%d')
-    lc = []
-    for jd, day in cal0.items():
-        day['date'] = jdftime(jd, '%y-%m-%d', ut=False)
-        if jd >= start and jd <= end:
-            lc.append((jd, day))
 
-    lc.sort()
-    res = [x[1] for x in lc]
+def term_of(jdn):
+    ''' estimated number of the last solar term before day jdn, from the
+    mean motion of the Sun, it may be off by one '''
+    year = jd2g(jdn)[0]
+    lon = (jdn - g2jd(year, 3, 20.5)) * 360.0 / 365.2422
+    return year * 24 + int(math.floor(lon / 15))
 
-    return res
+
+@lru_cache(maxsize=4096)
+def has_majorterm(k):
+    ''' whether the month of lunation k contains a major solar term(中气),
+    major terms are the even numbered ones '''
+    start, end = newmoonjdn(k), newmoonjdn(k + 1)
+    n = term_of(start) // 2 * 2
+    return any(start <= termjdn(x) < end for x in range(n - 2, n + 6, 2))
+
+
+@lru_cache(maxsize=1024)
+def lunaryear(year):
+    ''' lunar year from LC 11 of last Winter Solstice to LC 11 of the Winter
+    Solstice of year
+
+    Return:
+        (lunation of the first LC 11, lunation of the next LC 11)
+    '''
+    return (lunation_of(termjdn((year - 1) * 24 + 18)),
+            lunation_of(termjdn(year * 24 + 18)))
+
+
+def month_of(k):
+    ''' month number as in CN_MON of lunation k
+
+    A lunar year of 13 months has a leap month, the first month without
+    major solar term. Only the months from LC 11 to k are checked, a leap
+    month after k does not change the number of k.
+    '''
+    year = jd2g(newmoonjdn(k))[0]
+    k0, k1 = lunaryear(year)
+    if k >= k1:
+        k0, k1 = lunaryear(year + 1)
+
+    m = LCSTARTMONTH + k - k0
+    leap = False
+    if k1 - k0 > 12:
+        for j in range(k0 + 1, k + 1):
+            if not has_majorterm(j):
+                m -= 1
+                leap = j == k
+                break
+
+    if m > 12:
+        m -= 12
+    if leap:
+        m += 100  # add 100 to distinguish leap month
+    return m
+
+
+def lunarcal_range(start, end):
+    ''' compute lunar calendar for days from start to end, only the newmoons
+    and solar terms of the months covering the days, and those needed to
+    number the months, are searched
+
+    Args:
+        start, end: date in ISO format, like 2010-12-31
+    Return:
+        a new array of DAY_DTYPE, see lunarcal_rows
+    '''
+    first = int(jdptime(start, '%y-%m-%d') + 0.5)
+    # one more day to mark 除夕 and 寒食, which are the day before
+    last = int(jdptime(end, '%y-%m-%d') + 0.5) + 1
+    if last <= first:
+        return np.zeros(0, dtype=DAY_DTYPE)
+
+    days = np.zeros(last - first + 1, dtype=DAY_DTYPE)
+    days['jdn'] = np.arange(first, last + 1)
+
+    k = lunation_of(first)
+    while newmoonjdn(k) <= last:
+        monthstart = max(newmoonjdn(k), first)
+        inmonth = slice(monthstart - first, newmoonjdn(k + 1) - first)
+        days['month'][inmonth] = month_of(k)
+        days['day'][inmonth] = days['jdn'][inmonth] - newmoonjdn(k) + 1
+        k += 1
+
+    for n in range(term_of(first) - 1, term_of(last) + 2):
+        jdn = termjdn(n)
+        if first <= jdn <= last:
+            days['jieqi'][jdn - first] = n % 24 + 1
+
+    return mark_holiday(days)[:-1]
+
+
+def lunarcal_rows(days):
+    ''' iterate array of DAY_DTYPE as dictionaries with date in ISO format,
+    month, day, and lunardate, jieqi, holiday in Chinese '''
+    for jdn, month, day, jieqi, holiday in days.tolist():
+        yield {'date': jdftime(jdn - 0.5, '%y-%m-%d', ut=False),
+               'month': month,
+               'day': day,
+               'lunardate': CN_MON[month] if day == 1 else CN_DAY[day],
+               'jieqi': SOLARTERM_NAMES[jieqi],
+               'holiday': HOLIDAYS[holiday]}
 
 
 def main():
-    a = cn_lunarcal(2033)
+    a = lunarcal_rows(cn_lunarcal(2033))
     for x in a:
         print(x['date'], x['lunardate'], x['jieqi'], x['holiday'])
 
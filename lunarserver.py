@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' serve the Lunar Calendar over HTTP
+
+    GET /ics?start=2020-01-01&end=2022-12-31&variant=jieqi
+
+start and end default to the previous and the next year, variant is a name in
+lunar_ical.VARIANTS, full by default.
+
+    POST /convert  {"dates": ["2031-07-14", "2020-05-23"]}
+
+answers a JSON list of the lunar dates in the same order, see
+lunar_ical.convert_dates, and
+
+    GET /convert?date=2031-07-14
+
+answers the lunar date of one day, see lunar_ical.lunar_date.
+
+Calendars rendered are kept in a LRU cache keyed by the range and the variant.
+Each has an ETag, a request with If-None-Match of it is answered 304. The
+DTSTAMP is derived from the data, see lunar_ical.generate, so the ETag stays
+the same over restarts while the data does.
+
+Calendars are rendered in a thread pool, and the astronomical searches of the
+years not in db in a process pool if there is one, the event loop never waits
+on them. Run it by lunar_ical.py:
+
+    ./lunar_ical.py --serve=8080 --workers=4
+
+'''
+
+__license__ = 'BSD'
+__copyright__ = '2020, Chen Wei <weichen302@gmail.com>'
+__version__ = '0.0.3'
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import io
+import json
+import sys
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+import lunar_ical
+from lunarcalbase import LRUCache
+
+__all__ = ['CalendarServer', 'serve']
+
+# bytes of calendars kept in cache
+CACHE_BYTES = 64 * 1024 * 1024
+# the longest range of a calendar, in days
+MAX_DAYS = 250 * 366
+# seconds to wait for a request
+READ_TIMEOUT = 30
+# the largest request body accepted, in bytes
+MAX_BODY = 4 * 1024 * 1024
+REASONS = {200: 'OK',
+           304: 'Not Modified',
+           400: 'Bad Request',
+           404: 'Not Found',
+           405: 'Method Not Allowed',
+           413: 'Payload Too Large',
+           500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    ''' answer the request with status and message '''
+
+    def __init__(self, status, message=''):
+        Exception.__init__(self, message or REASONS[status])
+        self.status = status
+
+
+def render_ics(start, end, variant, executor=None):
+    ''' render a calendar from start to end
+    Return:
+        (body in bytes, ETag)
+    '''
+    buf = io.StringIO()
+    lunar_ical.generate(start, end, [lunar_ical.IcalSink(buf, variant)],
+                        executor, stable=True)
+    body = buf.getvalue().encode('utf-8')
+    return body, '"%s"' % hashlib.sha256(body).hexdigest()
+
+
+def etag_match(header, etag):
+    ''' whether If-None-Match header matches etag, weak tags match too '''
+    if header is None:
+        return False
+    tags = [x.strip() for x in header.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+
+class CalendarServer(object):
+    ''' the HTTP service, see module doc
+
+    Args:
+        executor: optional concurrent.futures.Executor to spread the
+                  astronomical searches on
+        cachebytes: size of calendars kept in cache
+        threads: size of the thread pool calendars are rendered in
+    '''
+
+    def __init__(self, executor=None, cachebytes=CACHE_BYTES, threads=None):
+        self.executor = executor
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.cache = LRUCache(cachebytes, sizeof=lambda x: len(x[0]))
+        # calendars being rendered, requests of the same one wait for it
+        self.pending = {}
+        self.routes = {'/ics': self.get_ics,
+                       '/convert': self.post_convert}
+
+    async def render(self, key, func, *args):
+        ''' call func(*args) in the thread pool and cache the result under
+        key, a request of the same key meanwhile waits for the same call '''
+        res = self.cache.get(key)
+        if res is not None:
+            return res
+
+        future = self.pending.get(key)
+        if future is None:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(self.pool, func, *args)
+            self.pending[key] = future
+            future.add_done_callback(lambda x: self.pending.pop(key, None))
+        # a client goes away does not cancel the rendering of others
+        res = await asyncio.shield(future)
+        self.cache.put(key, res)
+        return res
+
+    async def get_ics(self, method, query, headers, body):
+        if method not in ('GET', 'HEAD'):
+            raise HTTPError(405)
+        cy = datetime.today().year
+        start = query.get('start', ['%d-01-01' % (cy - 1)])[-1]
+        end = query.get('end', ['%d-12-31' % (cy + 1)])[-1]
+        variant = query.get('variant', ['full'])[-1]
+        try:
+            first, last = lunar_ical.isojdn(start), lunar_ical.isojdn(end)
+        except ValueError:
+            raise HTTPError(400, 'start and end must be dates like 2020-12-31')
+        if variant not in lunar_ical.VARIANTS:
+            raise HTTPError(400, 'unknown variant %s' % variant)
+        if first > last or last - first >= MAX_DAYS:
+            raise HTTPError(400, 'bad range from %s to %s' % (start, end))
+
+        payload, etag = await self.render(
+            ('ics', first, last, variant), render_ics,
+            lunar_ical.jdniso(first), lunar_ical.jdniso(last), variant,
+            self.executor)
+        hdrs = [('ETag', etag), ('Cache-Control', 'no-cache')]
+        if etag_match(headers.get('if-none-match'), etag):
+            return 304, hdrs, b''
+        hdrs.append(('Content-Type', 'text/calendar; charset=utf-8'))
+        return 200, hdrs, payload
+
+    async def post_convert(self, method, query, headers, body):
+        if method in ('GET', 'HEAD'):
+            return await self.get_convert(query)
+        if method != 'POST':
+            raise HTTPError(405)
+        try:
+            dates = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400, 'body is not JSON')
+        if isinstance(dates, dict):
+            dates = dates.get('dates')
+        if (not isinstance(dates, list) or
+                not all(isinstance(x, str) for x in dates)):
+            raise HTTPError(400, 'expect {"dates": [list of ISO dates]}')
+
+        loop = asyncio.get_event_loop()
+        try:
+            res = await loop.run_in_executor(self.pool,
+                                             lunar_ical.convert_dates, dates,
+                                             self.executor)
+        except ValueError as err:
+            raise HTTPError(400, 'bad date: %s' % err)
+        payload = json.dumps(res, ensure_ascii=False).encode('utf-8')
+        return 200, [('Content-Type', 'application/json')], payload
+
+    async def get_convert(self, query):
+        if 'date' not in query:
+            raise HTTPError(400, 'expect /convert?date=2031-07-14')
+        date = query['date'][-1]
+        try:
+            year = lunar_ical.jdnymd(lunar_ical.isojdn(date))[0]
+        except ValueError as err:
+            raise HTTPError(400, 'bad date: %s' % err)
+        if year in lunar_ical.MONTH_INDEX.years:
+            res = lunar_ical.lunar_date(date)
+        else:
+            # the year is loaded in the thread pool
+            loop = asyncio.get_event_loop()
+            res = await loop.run_in_executor(self.pool, lunar_ical.lunar_date,
+                                             date, self.executor)
+        payload = json.dumps(res, ensure_ascii=False).encode('utf-8')
+        return 200, [('Content-Type', 'application/json')], payload
+
+    async def respond(self, method, target, headers, body):
+        ''' dispatch a request, return (status, list of headers, body) '''
+        url = urlsplit(target)
+        route = self.routes.get(url.path)
+        try:
+            if route is None:
+                raise HTTPError(404)
+            return await route(method, parse_qs(url.query), headers, body)
+        except HTTPError as err:
+            return (err.status, [('Content-Type', 'text/plain; charset=utf-8')],
+                    (str(err) + '\n').encode('utf-8'))
+        except Exception as err:
+            print('error on %s %s: %r' % (method, target, err),
+                  file=sys.stderr)
+            return (500, [('Content-Type', 'text/plain; charset=utf-8')],
+                    b'Internal Server Error\n')
+
+    async def handle(self, reader, writer):
+        ''' serve one request of a connection '''
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                          READ_TIMEOUT)
+            lines = head.decode('latin-1').split('\r\n')
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    k, v = line.split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+            try:
+                method, target, _ = lines[0].split()
+                size = int(headers.get('content-length', 0))
+            except ValueError:
+                method, target = None, None
+            body = b''
+            if method is None:
+                status, hdrs, payload = (400, [], b'')
+            elif size > MAX_BODY or size < 0:
+                status, hdrs, payload = (413, [], b'')
+            else:
+                if size:
+                    body = await asyncio.wait_for(reader.readexactly(size),
+                                                  READ_TIMEOUT)
+                status, hdrs, payload = await self.respond(method, target,
+                                                           headers, body)
+            hdrs.append(('Content-Length', str(len(payload))))
+            hdrs.append(('Connection', 'close'))
+            res = ['HTTP/1.1 %d %s' % (status, REASONS[status])]
+            res.extend('%s: %s' % x for x in hdrs)
+            writer.write(('\r\n'.join(res) + '\r\n\r\n').encode('latin-1'))
+            if method != 'HEAD':
+                writer.write(payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def serve(host='127.0.0.1', port=8080, executor=None):
+    ''' serve the Lunar Calendar on host:port until interrupted '''
+    calserver = CalendarServer(executor)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(
+        asyncio.start_server(calserver.handle, host, port))
+    print('serving Lunar Calendar on http://%s:%d/ics' % (host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        calserver.close()
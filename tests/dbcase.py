@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' the base of tests on a db of their own '''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import astrostore
+import lunar_ical
+
+
+class DBTestCase(unittest.TestCase):
+    ''' a test on a new lunarcal.sqlite in a temporary directory, with the
+    store and the catalog of astrostore off, nothing of the checkout is read
+    or written
+
+    Attributes:
+        tmpdir: the temporary directory, removed after the test
+        initdb: whether the db is created before the test
+    '''
+
+    initdb = True
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(self.close_conns)
+        self.patch(lunar_ical, 'DB_FILE',
+                   os.path.join(self.tmpdir, 'lunarcal.sqlite'))
+        self.patch(astrostore, 'STORE_FILE', None)
+        self.patch(astrostore, 'CATALOG_FILE', None)
+        self.patch(astrostore, '_CATALOG', None)
+        lunar_ical.MONTH_INDEX.clear()
+        self.addCleanup(lunar_ical.MONTH_INDEX.clear)
+        if self.initdb:
+            lunar_ical.initdb()
+
+    def patch(self, obj, name, value):
+        ''' set attribute name of obj to value until the test ends '''
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def close_conns(self):
+        ''' close the connections of this thread to the db and the store '''
+        for conn in (getattr(lunar_ical._LOCAL, 'conns', None) or {}).values():
+            conn.close()
+        lunar_ical._LOCAL.conns = None
+        conn = getattr(astrostore._LOCAL, 'conn', None)
+        if conn is not None:
+            conn.close()
+        astrostore._LOCAL.conn = None
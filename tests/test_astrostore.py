@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' the store and the catalog of astronomical events '''
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aa_full
+import astrocatalog
+import astrostore
+from dbcase import DBTestCase
+from lunarcalbase import find_astro
+
+
+def child_put():
+    ''' runs in a forked worker, whether it opened its own connection '''
+    inherited = astrostore._LOCAL.conn
+    astrostore.put('newmoon', [(2, 2451609.1)])
+    return astrostore.connect() is not inherited
+
+
+class StoreTest(DBTestCase):
+
+    initdb = False
+
+    def setUp(self):
+        DBTestCase.setUp(self)
+        self.close_conns()
+        astrostore.STORE_FILE = os.path.join(self.tmpdir, 'astro.sqlite')
+
+    @unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(),
+                         'needs fork')
+    def test_fork(self):
+        astrostore.put('newmoon', [(1, 2451579.6)])
+        ctx = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            self.assertTrue(executor.submit(child_put).result())
+        # the connection of the parent is still good
+        self.assertEqual(astrostore.get('newmoon', 1), 2451579.6)
+        self.assertEqual(astrostore.get('newmoon', 2), 2451609.1)
+
+
+class CatalogTest(DBTestCase):
+
+    initdb = False
+
+    def setUp(self):
+        DBTestCase.setUp(self)
+        astrostore.CATALOG_FILE = os.path.join(self.tmpdir, 'catalog.bin')
+        self.solve = aa_full.solarterm
+        self.patch(aa_full, 'solarterm', aa_full.solarterm)
+        self.patch(aa_full, 'newmoon', aa_full.newmoon)
+
+    def tearDown(self):
+        if astrostore._CATALOG:
+            astrostore._CATALOG.close()
+
+    def test_covers_find_astro(self):
+        astrostore.build_catalog(astrostore.CATALOG_FILE, 2020, 2021)
+        # solving found no catalog, open the new one
+        astrostore._CATALOG = None
+        expect = [find_astro(y) for y in (2020, 2021)]
+
+        def unsolved(*args):
+            raise AssertionError('not in catalog: %r' % (args, ))
+        aa_full.solarterm = aa_full.newmoon = unsolved
+        self.assertEqual([find_astro(y) for y in (2020, 2021)], expect)
+
+        # the terms of 2022 before the 冬至 of 2021 are not
+        self.assertRaises(AssertionError, find_astro, 2022)
+
+    def test_truncated(self):
+        astrostore.build_catalog(astrostore.CATALOG_FILE, 2020, 2020)
+        with open(astrostore.CATALOG_FILE, 'rb') as f:
+            data = f.read()
+        for size in (0, 10, 80, len(data) - 8):
+            with open(astrostore.CATALOG_FILE, 'wb') as f:
+                f.write(data[:size])
+            astrostore._CATALOG = None
+            self.assertIsNone(astrostore.catalog())
+        self.assertEqual(astrostore.solarterm(2020, 0),
+                         self.solve(2020, 0))
+
+    def test_rejected(self):
+        n = 2020 * 24
+        jd = self.solve(2020, 0)
+        for engine, version in (('aa', astrostore.VERSION),
+                                (astrostore.ENGINE, '0.0.0')):
+            astrocatalog.write(astrostore.CATALOG_FILE, engine, version,
+                               0, [], n, [jd + 1])
+            astrostore._CATALOG = None
+            self.assertIsNone(astrostore.catalog())
+        self.assertEqual(astrostore.solarterm(2020, 0), jd)
+
+        # a catalog of the same engine is read
+        astrocatalog.write(astrostore.CATALOG_FILE, astrostore.ENGINE,
+                           astrostore.VERSION, 0, [], n, [jd + 1])
+        astrostore._CATALOG = None
+        self.assertIsNotNone(astrostore.catalog())
+        self.assertAlmostEqual(astrostore.solarterm(2020, 0), jd + 1, 6)
+        astrostore._CATALOG.close()
+
+        with open(astrostore.CATALOG_FILE, 'r+b') as f:
+            f.write(b'XCAT')
+        astrostore._CATALOG = None
+        self.assertIsNone(astrostore.catalog())
+        self.assertEqual(astrostore.solarterm(2020, 0), jd)
+
+
+if __name__ == '__main__':
+    unittest.main()
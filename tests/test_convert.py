@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' Gregorian to lunar date conversion '''
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunar_ical
+
+
+class ConvertTest(DBTestCase):
+
+    def test_invalid(self):
+        for x in ('2031-02-30', '2031-13-14', '2031-00-01', '1582-10-10',
+                  'x'):
+            self.assertRaises(ValueError, lunar_ical.isojdn, x)
+            self.assertRaises(ValueError, lunar_ical.convert_dates, [x])
+            self.assertRaises(ValueError, lunar_ical.lunar_date, x)
+
+    def test_order(self):
+        dates = ['2150-05-01', '2150-01-01', '2150-12-31', '2150-05-01']
+        res = lunar_ical.convert_dates(dates)
+        self.assertEqual([x['date'] for x in res], dates)
+        self.assertEqual(res, [lunar_ical.lunar_date(x) for x in dates])
+        self.assertEqual(res[0], res[3])
+
+    def test_load_while_lookup(self):
+        expect = lunar_ical.lunar_date('2150-05-01')
+        loader = threading.Thread(target=lunar_ical.MONTH_INDEX.load,
+                                  args=([2151, 2152],))
+        loader.start()
+        while loader.is_alive():
+            self.assertEqual(lunar_ical.lunar_date('2150-05-01'), expect)
+        loader.join()
+        self.assertEqual(lunar_ical.MONTH_INDEX.years, {2150, 2151, 2152})
+
+        lunar_ical.MONTH_INDEX.clear()
+        self.assertIsNone(lunar_ical.MONTH_INDEX.lookup(
+            lunar_ical.isojdn('2150-05-01'), 2150))
+        self.assertEqual(lunar_ical.lunar_date('2150-05-01'), expect)
+
+
+if __name__ == '__main__':
+    unittest.main()
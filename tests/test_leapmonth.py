@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' leap 11 and leap 12 of computed years are numbered as those of HKO '''
+
+import io
+import os
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunar_ical
+from lunarcalbase import cn_lunarcal
+from lunarcalbase import lunarcal_range
+
+
+class LeapElevenTest(DBTestCase):
+
+    initdb = False
+
+    def test_engine(self):
+        # 1642 has a leap 11, it starts 1642-12-22
+        months = set(cn_lunarcal(1642)['month'].tolist())
+        self.assertIn(111, months)
+        self.assertFalse(months & {99, 100})
+        months = set(lunarcal_range('1642-12-01', '1643-01-31')['month'])
+        self.assertEqual(months, {11, 111, 12})
+
+    def test_month_names(self):
+        codes = list(range(1, 13)) + list(range(101, 113))
+        self.assertEqual(sorted(lunar_ical.MONTH_NAME), codes)
+        # HKO files are parsed by the same names
+        for name, code in lunar_ical.CN_MON.items():
+            self.assertEqual(lunar_ical.MONTH_NAME[code], name)
+
+    def test_render(self):
+        lunar_ical.initdb()
+        buf = io.StringIO()
+        lunar_ical.gen_cal('1642-12-01', '1643-01-31', buf)
+        self.assertIn('閏十一月', buf.getvalue())
+
+        res = lunar_ical.lunar_date('1642-12-25')
+        self.assertEqual((res['month'], res['leap']), (11, True))
+        res = lunar_ical.convert_dates(['1642-12-25'])[0]
+        self.assertEqual(res['lunardate'], '閏十一月初四')
+
+    def test_upgrade(self):
+        # a db of schema 1 may have a computed leap 11 saved as month 99
+        lunar_ical.initdb()
+        conn = sqlite3.connect(lunar_ical.DB_FILE)
+        conn.execute('insert into ical values (?, 1642, 99, 4, 0, 0, 0, ?)',
+                     (lunar_ical.isojdn('1642-12-25'),
+                      lunar_ical.SOURCE_COMPUTED))
+        conn.execute('PRAGMA user_version=1')
+        conn.commit()
+        conn.close()
+
+        lunar_ical.initdb()
+        conn = sqlite3.connect(lunar_ical.DB_FILE)
+        row = conn.execute('select lmonth, leap from ical').fetchone()
+        conn.close()
+        self.assertEqual(row, (11, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
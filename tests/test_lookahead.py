@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' the days after Winter Solstice settled without the next year '''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunarcalbase
+
+
+class LookaheadTest(DBTestCase):
+
+    initdb = False
+
+    def setUp(self):
+        DBTestCase.setUp(self)
+        self.lookahead = lunarcalbase.lookahead
+        self.patch(lunarcalbase, 'lookahead', self.lookahead)
+
+    def check(self, year):
+        ''' cn_lunarcal of year with and without the lookahead, return
+        whether the lookahead settled it '''
+        cal = lunarcalbase.cn_lunarcal(year)
+        tails = []
+
+        def guarded(*args):
+            tails.append(self.lookahead(*args))
+            return tails[-1]
+        lunarcalbase.lookahead = guarded
+        self.assertEqual(lunarcalbase.cn_lunarcal(year).tolist(), cal.tolist())
+
+        lunarcalbase.lookahead = lambda *args: None
+        self.assertEqual(lunarcalbase.cn_lunarcal(year).tolist(), cal.tolist())
+        lunarcalbase.lookahead = self.lookahead
+        return tails[0] is not None
+
+    def test_settled(self):
+        # LC 12 of 2016 starts 2016-12-29, LC 11 of 2020 runs to the end
+        self.assertTrue(self.check(2016))
+        self.assertEqual(lunarcalbase.cn_lunarcal(2016)['month'][-1], 12)
+        self.assertTrue(self.check(2020))
+
+    def test_leap_after_solstice(self):
+        # the month after that of Winter Solstice is a leap 11, it has no 大寒
+        for year in (2033, 1642):
+            self.assertFalse(self.check(year))
+            months = lunarcalbase.cn_lunarcal(year)['month'].tolist()
+            self.assertEqual(months[-1], 111)
+
+
+if __name__ == '__main__':
+    unittest.main()
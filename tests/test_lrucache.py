@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' the LRU cache bounded by bytes '''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lunarcalbase import LRUCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache(10, sizeof=len)
+
+    def test_evict_by_bytes(self):
+        self.cache.put('a', 'xxxx')
+        self.cache.put('b', 'xxxx')
+        self.assertEqual(self.cache.nbytes, 8)
+        self.cache.put('c', 'xxx')
+        self.assertNotIn('a', self.cache)
+        self.assertEqual((len(self.cache), self.cache.nbytes), (2, 7))
+
+        # a value larger than the cache is not kept, nor evicts others
+        self.cache.put('d', 'x' * 11)
+        self.assertNotIn('d', self.cache)
+        self.assertEqual(self.cache.nbytes, 7)
+
+        # a value put again replaces its size
+        self.cache.put('b', 'x')
+        self.assertEqual(self.cache.nbytes, 4)
+
+    def test_recent(self):
+        self.cache.put('a', 'xxxx')
+        self.cache.put('b', 'xxxx')
+        self.assertEqual(self.cache.get('a'), 'xxxx')
+        self.cache.put('c', 'xxxx')
+        # b is the least recently used
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('b', 0), 0)
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries'],
+                          stats['bytes']), (1, 2, 2, 8))
+
+        self.cache.clear()
+        self.assertEqual((len(self.cache), self.cache.nbytes), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' lunar years of the days, wherever the days start '''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunar_ical
+from lunarcalbase import lunarcal_range
+
+
+class LunarYearTest(DBTestCase):
+
+    initdb = False
+
+    def test_start(self):
+        # 2020-01-25 is 正月初一 of 庚子, 2021-02-12 of 辛丑
+        for start, year in (('2019-12-31', 2019), ('2020-01-24', 2019),
+                            ('2020-01-25', 2020), ('2020-01-26', 2020)):
+            days = lunarcal_range(start, '2021-03-01')
+            lyears = lunar_ical.mark_lunaryear(days)
+            self.assertEqual(lyears[0], year, start)
+            self.assertEqual(lyears[-1], 2021, start)
+
+    def test_summary(self):
+        days = lunarcal_range('2020-01-25', '2020-01-26')
+        lyears = lunar_ical.mark_lunaryear(days).tolist()
+        summaries = dict(lunar_ical.full_summaries(days, lyears))
+        self.assertEqual(summaries[lunar_ical.isojdn('2020-01-25')],
+                         '庚子[鼠]正月 春节')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' upgrade of a db of the text schema '''
+
+import os
+import sqlite3
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunar_ical
+
+
+class MigrateTest(DBTestCase):
+
+    # the db of the text schema is made by the test
+    initdb = False
+
+    def test_hko_only(self):
+        conn = sqlite3.connect(lunar_ical.DB_FILE)
+        conn.execute('''CREATE TABLE ical (
+                        id INTEGER PRIMARY KEY,
+                        date TEXT UNIQUE,
+                        lunardate TEXT,
+                        holiday TEXT,
+                        jieqi TEXT,
+                        source TEXT)''')
+        conn.executemany(
+            'insert into ical (date, lunardate, jieqi, source) '
+            'values (?, ?, ?, ?)',
+            [('2020-01-25', '正月', '', lunar_ical.SOURCE_HKO),
+             ('2020-01-26', '初二', '', lunar_ical.SOURCE_HKO),
+             ('2020-01-27', '初三', '', 'aa_full')])
+        conn.commit()
+        conn.close()
+
+        lunar_ical.initdb()
+        conn = sqlite3.connect(lunar_ical.DB_FILE)
+        rows = conn.execute('select jdn, lyear, lmonth, lday, source '
+                            'from ical order by jdn').fetchall()
+        conn.close()
+        jdn = lunar_ical.isojdn('2020-01-25')
+        self.assertEqual(rows, [(jdn, 2020, 1, 1, lunar_ical.SOURCE_HKO),
+                                (jdn + 1, 2020, 1, 2, lunar_ical.SOURCE_HKO)])
+
+
+if __name__ == '__main__':
+    unittest.main()
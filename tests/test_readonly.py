@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' render from a db that can not be written '''
+
+import io
+import os
+import sqlite3
+import sys
+import unittest
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunar_ical
+
+
+class ReadOnlyTest(DBTestCase):
+
+    def readonly(self):
+        ''' switch to a fresh db, every write to it fails like on a
+        read-only checkout. Return the connect of lunar_ical '''
+        lunar_ical.DB_FILE = os.path.join(self.tmpdir, 'readonly.sqlite')
+        lunar_ical.initdb()
+        uri = ('file:%s?mode=ro' %
+               urllib.request.pathname2url(lunar_ical.DB_FILE))
+        conn = sqlite3.connect(uri, uri=True)
+        self.addCleanup(conn.close)
+        connect = lunar_ical.connect
+        self.patch(lunar_ical, 'connect', lambda readonly=True: conn)
+        return connect
+
+    def test_compute(self):
+        first, last = lunar_ical.isojdn('2020-01-01'), lunar_ical.isojdn(
+            '2020-12-31')
+        expect = [x.tolist() for x in lunar_ical.compute_days(first, last)]
+        connect = self.readonly()
+        for _ in range(2):
+            self.assertEqual([x.tolist() for x in
+                              lunar_ical.compute_days(first, last)], expect)
+        lunar_ical.connect = connect
+        self.assertEqual(lunar_ical.query_db('select * from computed'), [])
+
+    def test_render(self):
+        expect = io.StringIO()
+        lunar_ical.gen_cal('2020-01-01', '2020-12-31', expect, stable=True)
+        connect = self.readonly()
+        for _ in range(2):
+            buf = io.StringIO()
+            lunar_ical.gen_cal('2020-01-01', '2020-12-31', buf, stable=True)
+            self.assertEqual(buf.getvalue(), expect.getvalue())
+        lunar_ical.connect = connect
+        self.assertEqual(lunar_ical.query_db('select * from fragments'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
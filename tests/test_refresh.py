@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' load and refresh the HKO table from a local mirror or server '''
+
+import contextlib
+import hashlib
+import http.server
+import io
+import os
+import sqlite3
+import sys
+import tarfile
+import threading
+import unittest
+import urllib.error
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunar_ical
+from lunarcalbase import lunarcal_range
+
+YEARS = range(2020, 2023)
+
+
+def make_mirror(path):
+    ''' write HKO files of YEARS to directory path, the days are computed '''
+    daynames = dict((v, k) for k, v in lunar_ical.CN_DAY.items())
+    days = lunarcal_range('%d-01-01' % YEARS[0], '%d-12-31' % YEARS[-1])
+    pages = dict((y, ['%d(%d)公曆與農曆日期對照表' % (y, y), '',
+                      '公曆日期    農曆日期    星期    節氣', ''])
+                 for y in YEARS)
+    for d in days:
+        y, m, day = lunar_ical.jdnymd(int(d['jdn']))
+        if d['day'] == 1:
+            name = lunar_ical.MONTH_NAME[int(d['month'])]
+        else:
+            name = daynames[int(d['day'])]
+        line = '%d年%d月%d日   %s   星期一' % (y, m, day, name)
+        if d['jieqi']:
+            line += '   %s' % lunar_ical.SOLARTERM_NAMES[d['jieqi']]
+        pages[y].append(line)
+    os.mkdir(path)
+    for y, lines in pages.items():
+        with open(os.path.join(path, 'T%dc.txt' % y), 'wb') as f:
+            f.write('\r\n'.join(lines + ['']).encode('utf-8'))
+    return days
+
+
+class HKOHandler(http.server.BaseHTTPRequestHandler):
+    ''' serve HKO files of a directory with ETags like hk Obs
+
+    Attributes:
+        root: the directory of the files
+        fail: names of the files answered 503 once
+        log: list of (name, status) answered
+    '''
+
+    root = None
+    fail = set()
+    log = []
+
+    def do_GET(self):
+        name = os.path.basename(self.path)
+        path = os.path.join(self.root, name)
+        if name in self.fail:
+            self.fail.discard(name)
+            return self.answer(name, 503)
+        if not os.path.isfile(path):
+            return self.answer(name, 404)
+
+        with open(path, 'rb') as f:
+            body = f.read()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            return self.answer(name, 304, etag)
+        self.answer(name, 200, etag, body)
+
+    def answer(self, name, status, etag=None, body=b''):
+        self.log.append((name, status))
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def read_table():
+    conn = sqlite3.connect(lunar_ical.DB_FILE)
+    rows = conn.execute('select * from ical order by jdn').fetchall()
+    conn.close()
+    return rows
+
+
+class RefreshTest(DBTestCase):
+
+    def setUp(self):
+        DBTestCase.setUp(self)
+        self.patch(lunar_ical, 'HKO_YEARS', YEARS)
+        self.mirror = os.path.join(self.tmpdir, 'mirror')
+        self.days = make_mirror(self.mirror)
+
+    def test_refresh(self):
+        lunar_ical.update_cal(self.mirror)
+        table = read_table()
+        self.assertEqual(len(table), len(self.days))
+        self.assertEqual(set(x[-1] for x in table), {lunar_ical.SOURCE_HKO})
+        res = lunar_ical.lunar_date('2020-01-25')
+        self.assertEqual((res['lyear'], res['month'], res['day']),
+                         (2020, 1, 1))
+
+        self.assertEqual(lunar_ical.refresh_cal(self.mirror), [])
+
+        # a file changed is loaded again, the days of it are the same
+        with open(os.path.join(self.mirror, 'T2021c.txt'), 'ab') as f:
+            f.write(b'\r\n')
+        self.assertEqual(lunar_ical.refresh_cal(self.mirror), [2021])
+        self.assertEqual(read_table(), table)
+        self.assertEqual(lunar_ical.lunar_date('2020-01-25'), res)
+
+        tarball = os.path.join(self.tmpdir, 'hko.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            tar.add(self.mirror, 'files')
+        self.assertEqual(lunar_ical.refresh_cal(tarball), [])
+
+    def test_stdout(self):
+        # the status of HKO and computed days stays out of the calendar
+        lunar_ical.update_cal(self.mirror)
+        for gen in (lunar_ical.gen_cal, lunar_ical.gen_cal_jieqi_only):
+            buf = io.StringIO()
+            with contextlib.redirect_stdout(buf):
+                gen('2019-12-01', '2023-01-31', sys.stdout)
+            ics = buf.getvalue()
+            self.assertTrue(ics.startswith('BEGIN:VCALENDAR\n'))
+            self.assertTrue(ics.endswith('END:VCALENDAR'))
+            self.assertNotIn('HKO\n', ics)
+            self.assertNotIn('algorithm', ics)
+
+
+class HKOServerTest(DBTestCase):
+
+    def setUp(self):
+        DBTestCase.setUp(self)
+        self.patch(lunar_ical, 'HKO_YEARS', YEARS)
+        root = os.path.join(self.tmpdir, 'files')
+        self.days = make_mirror(root)
+        self.handler = type('Handler', (HKOHandler, ),
+                            {'root': root, 'fail': set(), 'log': []})
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     self.handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+        self.patch(lunar_ical, 'URL', 'http://127.0.0.1:%d/T%%dc.txt' %
+                   self.httpd.server_address[1])
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def test_fetch(self):
+        # a server error is retried, a missing file is not
+        self.handler.fail.add('T2021c.txt')
+        fetched = lunar_ical.fetch_pages(list(YEARS))
+        for year, (page, etag, modified) in zip(YEARS, fetched):
+            self.assertEqual(lunar_ical.parse_hko(page)[0][0],
+                             lunar_ical.isojdn('%d-01-01' % year))
+            self.assertTrue(etag)
+        log = self.handler.log
+        self.assertEqual([x for x in log if x[0] == 'T2021c.txt'],
+                         [('T2021c.txt', 503), ('T2021c.txt', 200)])
+        self.assertEqual(len(log), len(YEARS) + 1)
+
+        self.assertRaises(urllib.error.HTTPError, lunar_ical.fetch_pages,
+                          [2023])
+        self.assertEqual(log[-1], ('T2023c.txt', 404))
+        self.assertEqual(len(log), len(YEARS) + 2)
+
+        lunar_ical.update_cal()
+        self.assertEqual(len(read_table()), len(self.days))
+
+    def test_conditional(self):
+        lunar_ical.update_cal()
+        table = read_table()
+        del self.handler.log[:]
+        self.assertEqual(lunar_ical.refresh_cal(), [])
+        self.assertEqual(sorted(self.handler.log),
+                         [('T%dc.txt' % y, 304) for y in YEARS])
+
+        # the new ETag is kept, the next refresh is conditional on it
+        with open(os.path.join(self.handler.root, 'T2021c.txt'), 'ab') as f:
+            f.write(b'\r\n')
+        del self.handler.log[:]
+        self.assertEqual(lunar_ical.refresh_cal(), [2021])
+        self.assertEqual(sorted(self.handler.log),
+                         [('T2020c.txt', 304), ('T2021c.txt', 200),
+                          ('T2022c.txt', 304)])
+        self.assertEqual(read_table(), table)
+        self.assertEqual(lunar_ical.refresh_cal(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' the HTTP service on localhost '''
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbcase import DBTestCase
+import lunar_ical
+import lunarserver
+
+
+class ServerTest(DBTestCase):
+
+    def setUp(self):
+        DBTestCase.setUp(self)
+        self.calserver = lunarserver.CalendarServer()
+        # as lunarserver.serve, on port 0 the system picks a free one
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.calserver.handle, '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        self.base = 'http://127.0.0.1:%d' % port
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.calserver.close()
+
+    def request(self, path, data=None, headers=None, method=None):
+        ''' return (status, headers, body) '''
+        req = urllib.request.Request(self.base + path, data=data,
+                                     headers=headers or {}, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=60) as f:
+                return f.status, f.headers, f.read()
+        except urllib.error.HTTPError as err:
+            return err.code, err.headers, err.read()
+
+    def test_ics(self):
+        path = '/ics?start=2020-01-01&end=2020-02-29&variant=jieqi'
+        status, headers, body = self.request(path)
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['Content-Type'].startswith('text/calendar'))
+        self.assertIn('立春'.encode('utf-8'), body)
+        etag = headers['ETag']
+
+        status, headers, body = self.request(path,
+                                             headers={'If-None-Match': etag})
+        self.assertEqual((status, headers['ETag'], body), (304, etag, b''))
+
+        status, headers, body = self.request(path, method='HEAD')
+        self.assertEqual((status, headers['ETag'], body), (200, etag, b''))
+
+        for path in ('/ics?start=2020-02-30', '/ics?variant=none',
+                     '/ics?start=2020-12-31&end=2020-01-01'):
+            self.assertEqual(self.request(path)[0], 400)
+
+    def test_convert(self):
+        dates = ['2031-07-14', '2020-05-23', '2020-01-25']
+        status, headers, body = self.request(
+            '/convert', json.dumps({'dates': dates}).encode('utf-8'))
+        self.assertEqual(status, 200)
+        res = json.loads(body.decode('utf-8'))
+        self.assertEqual([x['date'] for x in res], dates)
+        self.assertEqual(res, lunar_ical.convert_dates(dates))
+
+        status, headers, body = self.request('/convert?date=2020-05-23')
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8')), res[1])
+
+        self.assertEqual(self.request('/convert?date=2020-02-30')[0], 400)
+        self.assertEqual(self.request('/convert', b'["2020-02-30"]')[0], 400)
+        self.assertEqual(self.request('/convert', b'not json')[0], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()